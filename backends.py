@@ -0,0 +1,615 @@
+import os
+import re
+import time
+import uuid
+import random
+import datetime
+import threading
+from collections import Counter, defaultdict
+
+import metrics
+from batch import BatchWriter
+from horizon import day_offset, iso_dates
+from storage import atomic_write
+from sync import parse_recurrence, series_days
+
+SCOPES = 'https://www.googleapis.com/auth/calendar'
+CLIENT_SECRET_FILE = 'client_secret.json'
+APPLICATION_NAME = 'Google Calendar API Python Quickstart'
+CREDENTIAL_DIR = os.path.join(os.path.expanduser('~'), '.credentials')
+DISCOVERY_URI = 'https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest'
+# how long the cached discovery document is used before fetching it again
+DISCOVERY_MAX_AGE = 30 * 24 * 60 * 60
+# the most events the Calendar API returns in a page
+PAGE_SIZE = 2500
+
+ICS_DIRECTORY = os.path.join('schedule', 'calendars')
+PRODID = '-//Google-calendar-CLI//Experiment schedule//EN'
+# iCalendar has no extended properties, so the experiment marker is kept in
+# a property of its own
+EXPERIMENT_PROPERTY = 'X-EXPERIMENT'
+TEXT_PROPERTIES = {'SUMMARY': 'summary', 'LOCATION': 'location', 'DESCRIPTION': 'description'}
+
+
+class CalendarBackend:
+    '''
+    Where the experiments' events are kept. The Calendar only uses these
+    methods, so scheduling and syncing work the same whichever backend is
+    chosen.
+
+    Writes are (method, kwargs) pairs for the Calendar API's events
+    collection, e.g. ('insert', {'calendarId': ..., 'body': {...}}) or
+    ('delete', {'calendarId': ..., 'eventId': ...}), and events are Calendar
+    API event resources.
+    '''
+
+    name = None
+
+    def connect(self):
+        '''Gets ready to send requests (e.g. authorises), so the first one doesn't have to wait'''
+
+    def flush(self):
+        '''
+        Finishes off the writes made so far, e.g. by saving the files they
+        changed. Called at the end of each update, even if it was stopped.
+        '''
+
+    def close(self):
+        '''Lets go of anything kept between requests, e.g. connections'''
+
+    def write(self, items, on_success=None):
+        '''
+        Sends calendar writes, calling on_success with each one that goes
+        through, and returns a list of (item, error) for any which failed.
+        items can be any iterable, e.g. a generator, and are only read as
+        fast as they can be sent.
+        '''
+        raise NotImplementedError
+
+    def insert(self, calendar_id, events, on_success=None):
+        return self.write((('insert', {'calendarId': calendar_id, 'body': event}) for event in events),
+                          on_success)
+
+    def delete(self, calendar_id, event_ids, on_success=None):
+        return self.write((('delete', {'calendarId': calendar_id, 'eventId': event_id}) for event_id in event_ids),
+                          on_success)
+
+    def list(self, calendar_id, sync_token=None):
+        '''
+        The events in a calendar, with recurring events given as their
+        occurrences, and a sync token. Given the token from an earlier list
+        only the events changed since are returned, deleted ones marked
+        cancelled. An error with status 410 is raised if the token is no
+        longer accepted, and the whole calendar has to be listed again.
+        '''
+        raise NotImplementedError
+
+
+class ServiceBackend(CalendarBackend):
+    '''
+    A backend with a Calendar v3 service, whose writes are sent in batches
+    by a BatchWriter (writer_options are passed on to it). The writer, with
+    its workers and connections, is kept for as long as the backend.
+    '''
+
+    def __init__(self, service=None, **writer_options):
+        self._service = service
+        self.writer_options = writer_options
+        self._writer = None
+
+    @property
+    def service(self):
+        self.connect()
+        return self._service
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            self._writer = self.create_writer()
+        return self._writer
+
+    def create_writer(self):
+        return BatchWriter(self.service, **self.writer_options)
+
+    def write(self, items, on_success=None):
+        return self.writer.write(items, on_success)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def list(self, calendar_id, sync_token=None):
+        request = {'calendarId': calendar_id, 'singleEvents': True, 'maxResults': PAGE_SIZE}
+        if sync_token:
+            request['syncToken'] = sync_token
+
+        events = []
+        while True:
+            page = self.service.events().list(**request).execute()
+            events.extend(page.get('items', []))
+            if 'nextPageToken' not in page:
+                break
+            request['pageToken'] = page['nextPageToken']
+        return events, page.get('nextSyncToken')
+
+
+class GoogleBackend(ServiceBackend):
+    '''
+    The Google calendars themselves. The service is only authorised when
+    it's first needed, and batches of writes are sent in parallel, each
+    over its own authorised connection from a pool kept between writes.
+    '''
+
+    name = 'google'
+
+    def connect(self):
+        if self._service is None:
+            self.authorise()
+
+    def create_writer(self):
+        import httplib2
+
+        return BatchWriter(self.service, http_factory=lambda: self.credentials.authorize(httplib2.Http()),
+                           **self.writer_options)
+
+    @metrics.timer('authorise')
+    def authorise(self):
+        """Gets valid user credentials from storage.
+
+        If nothing has been stored, or if the stored credentials are invalid,
+        the OAuth2 flow is completed to obtain the new credentials.
+
+        """
+        import httplib2
+        from oauth2client import client
+        from oauth2client import tools
+        from oauth2client.file import Storage
+
+        if not os.path.exists(CREDENTIAL_DIR):
+            os.makedirs(CREDENTIAL_DIR)
+        credential_path = os.path.join(CREDENTIAL_DIR,
+                                       'calendar-python-quickstart.json')
+
+        store = Storage(credential_path)
+        self.credentials = store.get()
+        if not self.credentials or self.credentials.invalid:
+            flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
+            flow.user_agent = APPLICATION_NAME
+            # command line arguments are handled by click, so run the flow
+            # with the default oauth2client flags
+            self.credentials = tools.run_flow(flow, store, tools.argparser.parse_args([]))
+            print('Storing credentials to ' + credential_path)
+
+        self.http = self.credentials.authorize(httplib2.Http())
+        self._service = build_service(self.http)
+
+
+class MemoryHttpError(Exception):
+    '''An error from the MemoryService, with its status where googleapiclient's HttpError has it'''
+
+    def __init__(self, status, reason=''):
+        super().__init__(f'{status} {reason}'.strip())
+        self.resp = _Response(status)
+
+
+class _Response:
+
+    def __init__(self, status):
+        self.status = status
+
+
+class MemoryService:
+    '''
+    Calendars held in memory behind the same interface as the Calendar v3
+    discovery service, so the program (and its uploads) can run, and API
+    calls be counted, without a network.
+
+    Each round trip (a single request or a whole batch) sleeps for `latency`
+    seconds, and failure_rate of the writes fail at random with a 503, as
+    Google's do now and then.
+
+    Every change to an event is numbered, and list() hands out the latest
+    number as its sync token, so incremental syncs only return the events
+    changed since.
+
+    Recurring events must use the recurrence rules made by sync.series_rule().
+    Listing with singleEvents gives their occurrences, and the occurrences
+    a change removed are listed as cancelled.
+    '''
+
+    def __init__(self, latency=0.0, page_size=250, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.page_size = page_size
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.calendars = defaultdict(dict)  # calendarId -> {eventId: event}
+        self.calls = Counter()  # API calls made, by method
+        self.round_trips = 0
+        self.changes = 0  # number of the last change made to any event
+        self._lock = threading.Lock()
+
+    def events(self):
+        return _Events(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self, callback)
+
+    def round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def handle(self, method, kwargs):
+        with self._lock:
+            self.calls[method] += 1
+            if method != 'list' and self.failure_rate and self._random.random() < self.failure_rate:
+                raise MemoryHttpError(503, 'Backend Error')
+
+            events = self.calendars[kwargs['calendarId']]
+            if method == 'list':
+                return self.list_page(events, kwargs)
+            if method == 'insert':
+                event = dict(kwargs['body'])
+                event.setdefault('status', 'confirmed')
+                # like Google, the IDs of deleted events can't be reused
+                if event.get('id') in events:
+                    raise MemoryHttpError(409, 'The requested identifier already exists.')
+                event.setdefault('id', f'external{self.changes}')
+                return self.store(events, event)
+
+            event_id = kwargs['eventId']
+            if event_id not in events:
+                raise MemoryHttpError(404, 'Not Found')
+            if method == 'delete':
+                if events[event_id]['status'] == 'cancelled':
+                    raise MemoryHttpError(410, 'Resource has been deleted')
+                self.store(events, dict(events[event_id], status='cancelled'))
+                return ''
+            if method == 'update':
+                event = dict(kwargs['body'], id=event_id)
+                event.setdefault('status', 'confirmed')
+                return self.store(events, event)
+            raise NotImplementedError(method)
+
+    def store(self, events, event):
+        self.changes += 1
+        event['_change'] = self.changes
+        if 'recurrence' in event:
+            start = event['start'].get('dateTime') or event['start']['date']
+            first = day_offset(datetime.datetime.strptime(start[:10], '%Y-%m-%d'))
+            try:
+                event['_occurrences'] = series_days(parse_recurrence(first, event['recurrence']))
+            except ValueError:
+                # recurring events this program didn't write, e.g. read from
+                # someone else's .ics file, are kept as they are but only
+                # listed on their first day
+                pass
+        previous = events.get(event['id'], {})
+        if previous.get('_occurrences'):
+            event['_previous'] = previous['_occurrences']
+        events[event['id']] = event
+        return event
+
+    def restore(self, calendar_id, events):
+        '''Puts events into a calendar as they are, e.g. when read back from a file'''
+        with self._lock:
+            for event in events:
+                self.store(self.calendars[calendar_id], dict(event, status=event.get('status', 'confirmed')))
+
+    def list_page(self, events, kwargs):
+        '''One page of events, all of them or only those changed since the sync token'''
+        if 'syncToken' in kwargs:
+            since = int(kwargs['syncToken'])
+            matching = [event for event in events.values() if event['_change'] > since]
+        else:
+            # cancelled events are only listed by incremental syncs
+            matching = [event for event in events.values()
+                        if event['status'] != 'cancelled' or kwargs.get('showDeleted')]
+        matching.sort(key=lambda event: event['_change'])
+        if kwargs.get('singleEvents'):
+            matching = [instance for event in matching for instance in self.instances(event)
+                        if instance['status'] != 'cancelled' or 'syncToken' in kwargs or kwargs.get('showDeleted')]
+
+        start = int(kwargs.get('pageToken') or 0)
+        size = min(kwargs.get('maxResults') or self.page_size, self.page_size)
+        page = {'items': [{key: value for key, value in event.items() if not key.startswith('_')}
+                          for event in matching[start:start + size]]}
+        if start + size < len(matching):
+            page['nextPageToken'] = str(start + size)
+        else:
+            page['nextSyncToken'] = str(self.changes)
+        return page
+
+    def instances(self, event):
+        '''A recurring event's occurrences (or the event itself, if it's a single one)'''
+        if 'recurrence' not in event:
+            yield event
+            return
+        if '_occurrences' not in event:
+            yield {key: value for key, value in event.items() if key != 'recurrence'}
+            return
+        current = set() if event['status'] == 'cancelled' else set(event['_occurrences'])
+        days = sorted(current | set(event.get('_previous', ())))
+        times = {key: event[key]['dateTime'][10:] for key in ('start', 'end')}
+        for day, date in zip(days, iso_dates(days).tolist()):
+            instance = {key: value for key, value in event.items() if key not in ('recurrence', 'id')}
+            instance.update({key: dict(event[key], dateTime=date + times[key]) for key in ('start', 'end')})
+            instance.update(id=f"{event['id']}_{date.replace('-', '')}", recurringEventId=event['id'],
+                            status='confirmed' if day in current else 'cancelled')
+            yield instance
+
+    def live_events(self, calendar_id):
+        return {event_id: event for event_id, event in self.calendars[calendar_id].items()
+                if event['status'] != 'cancelled'}
+
+
+class _Events:
+
+    def __init__(self, service):
+        self.service = service
+
+    def insert(self, **kwargs):
+        return _Request(self.service, 'insert', kwargs)
+
+    def delete(self, **kwargs):
+        return _Request(self.service, 'delete', kwargs)
+
+    def update(self, **kwargs):
+        return _Request(self.service, 'update', kwargs)
+
+    def list(self, **kwargs):
+        return _Request(self.service, 'list', kwargs)
+
+
+class _Request:
+
+    def __init__(self, service, method, kwargs):
+        self.service = service
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self, http=None):
+        self.service.round_trip()
+        return self.service.handle(self.method, self.kwargs)
+
+
+class _Batch:
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request))
+
+    def execute(self, http=None):
+        # the whole batch costs a single round trip
+        self.service.round_trip()
+        for request_id, request in self.requests:
+            try:
+                response, exception = self.service.handle(request.method, request.kwargs), None
+            except MemoryHttpError as e:
+                response, exception = None, e
+            if self.callback:
+                self.callback(request_id, response, exception)
+
+
+class MemoryBackend(ServiceBackend):
+    '''
+    Calendars kept in memory by a MemoryService, for trying the program out
+    or timing it without Google. Each round trip takes `latency` seconds,
+    and failure_rate of the writes fail (and are retried) as Google's can.
+    '''
+
+    name = 'memory'
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None, **writer_options):
+        super().__init__(MemoryService(latency, failure_rate=failure_rate, seed=seed), **writer_options)
+        # sync tokens are only good for the events held by this backend, not
+        # those of an earlier run
+        self.session = uuid.uuid4().hex
+
+    def list(self, calendar_id, sync_token=None):
+        if sync_token:
+            session, _, sync_token = sync_token.partition(':')
+            if session != self.session:
+                raise MemoryHttpError(410, 'Sync token is no longer valid, a full sync is required.')
+        events, sync_token = super().list(calendar_id, sync_token)
+        return events, f'{self.session}:{sync_token}'
+
+
+class IcsBackend(MemoryBackend):
+    '''
+    Keeps each calendar as an iCalendar file in directory, which can be
+    imported into (or subscribed to from) Google Calendar, Outlook and so on.
+
+    A calendar's events are read from its file the first time it's used and
+    then held in memory, as the MemoryBackend's are. Writes only change the
+    events in memory, and flush() (at the end of each update) saves the
+    calendars changed since, each with a single write of the whole file.
+    '''
+
+    name = 'ics'
+
+    def __init__(self, directory=ICS_DIRECTORY, **options):
+        super().__init__(**options)
+        self.directory = directory
+        self.loaded = set()
+        self.unsaved = []  # calendars written to since the last flush()
+
+    def path(self, calendar_id):
+        return os.path.join(self.directory, re.sub(r'[^\w.@-]', '_', calendar_id) + '.ics')
+
+    def load(self, calendar_id):
+        if calendar_id in self.loaded:
+            return
+        self.loaded.add(calendar_id)
+        if os.path.exists(self.path(calendar_id)):
+            with open(self.path(calendar_id), 'r', encoding='utf-8', newline='') as file:
+                self.service.restore(calendar_id, read_ics(file.read()))
+
+    @metrics.timer('save calendar files')
+    def save(self, calendar_id):
+        document = write_ics(self.service.live_events(calendar_id).values()).encode()
+        with atomic_write(self.path(calendar_id), 'wb') as file:
+            file.write(document)
+        metrics.count('bytes written to calendar files', len(document))
+
+    def write(self, items, on_success=None):
+        def loaded(items):
+            for item in items:
+                calendar_id = item[1]['calendarId']
+                if calendar_id not in self.unsaved:
+                    self.load(calendar_id)
+                    self.unsaved.append(calendar_id)
+                yield item
+
+        return super().write(loaded(items), on_success)
+
+    def flush(self):
+        for calendar_id in self.unsaved:
+            self.save(calendar_id)
+        self.unsaved = []
+
+    def close(self):
+        self.flush()
+        super().close()
+
+    def list(self, calendar_id, sync_token=None):
+        self.load(calendar_id)
+        return super().list(calendar_id, sync_token)
+
+
+BACKENDS = {
+    'google': GoogleBackend,
+    'memory': MemoryBackend,
+    'ics': IcsBackend,
+}
+
+
+def get_backend(name='google', **options):
+    if name not in BACKENDS:
+        raise ValueError(f"\nERROR: Unknown calendar backend '{name}'. Choose from {', '.join(BACKENDS)}.")
+    return BACKENDS[name](**options)
+
+
+@metrics.timer('discovery')
+def build_service(http):
+    """
+    Builds the Calendar v3 service from a copy of its discovery document kept
+    on disk, rather than fetching the document on every run.
+    """
+    from apiclient import discovery
+
+    cache_path = os.path.join(CREDENTIAL_DIR, 'calendar-v3-discovery.json')
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < DISCOVERY_MAX_AGE:
+        with open(cache_path, 'r') as file:
+            document = file.read()
+    else:
+        response, content = http.request(DISCOVERY_URI)
+        if response.status != 200:
+            # fall back to letting the client library fetch the document itself
+            return discovery.build('calendar', 'v3', http=http)
+        document = content.decode() if isinstance(content, bytes) else content
+        # written in one step, as other runs may be reading it
+        with atomic_write(cache_path) as file:
+            file.write(document)
+
+    return discovery.build_from_document(document, http=http)
+
+
+def write_ics(events):
+    '''An iCalendar document of Calendar API events'''
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}', 'CALSCALE:GREGORIAN']
+    for event in events:
+        lines += ['BEGIN:VEVENT', f"UID:{event['id']}", f'DTSTAMP:{stamp}',
+                  ics_moment('DTSTART', event['start']), ics_moment('DTEND', event['end'])]
+        lines += [f'{name}:{escape(event[key])}' for name, key in TEXT_PROPERTIES.items() if event.get(key)]
+        # the RRULE and EXDATE lines are already in iCalendar's format
+        lines += event.get('recurrence', [])
+        experiment = event.get('extendedProperties', {}).get('private', {}).get('experiment')
+        if experiment:
+            lines.append(f'{EXPERIMENT_PROPERTY}:{escape(experiment)}')
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return ''.join(fold(line) + '\r\n' for line in lines)
+
+
+def read_ics(document):
+    '''The events in an iCalendar document, as Calendar API events'''
+    events, event = [], None
+    # lines starting with whitespace carry on the line before
+    for line in re.sub(r'\r?\n[ \t]', '', document).splitlines():
+        name, _, value = line.partition(':')
+        name, *parameters = name.upper().split(';')
+        if line == 'BEGIN:VEVENT':
+            event = {}
+        elif line == 'END:VEVENT':
+            events.append(event)
+            event = None
+        elif event is None:
+            continue
+        elif name == 'UID':
+            event['id'] = value
+        elif name in ('DTSTART', 'DTEND'):
+            event['start' if name == 'DTSTART' else 'end'] = api_moment(parameters, value)
+        elif name in TEXT_PROPERTIES:
+            event[TEXT_PROPERTIES[name]] = unescape(value)
+        elif name in ('RRULE', 'EXDATE', 'RDATE'):
+            event.setdefault('recurrence', []).append(line)
+        elif name == EXPERIMENT_PROPERTY:
+            event['extendedProperties'] = {'private': {'experiment': unescape(value)}}
+    return events
+
+
+def ics_moment(name, moment):
+    '''A DTSTART or DTEND line for a Calendar API start or end'''
+    if 'date' in moment:
+        return f"{name};VALUE=DATE:{moment['date'].replace('-', '')}"
+    value = moment['dateTime'][:19].replace('-', '').replace(':', '')
+    if moment['dateTime'].endswith('Z'):
+        return f'{name}:{value}Z'
+    if moment.get('timeZone'):
+        return f"{name};TZID={moment['timeZone']}:{value}"
+    return f'{name}:{value}'
+
+
+def api_moment(parameters, value):
+    '''The Calendar API start or end for a DTSTART or DTEND value'''
+    parameters = dict(parameter.partition('=')[::2] for parameter in parameters)
+    date = f'{value[:4]}-{value[4:6]}-{value[6:8]}'
+    if parameters.get('VALUE') == 'DATE' or len(value) == 8:
+        return {'date': date}
+    moment = {'dateTime': f'{date}T{value[9:11]}:{value[11:13]}:{value[13:15]}' + value[15:16]}
+    if 'TZID' in parameters:
+        moment['timeZone'] = parameters['TZID']
+    return moment
+
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def unescape(text):
+    return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), text)
+
+
+def fold(line):
+    '''Splits a line into lines of at most 75 bytes, as iCalendar asks'''
+    if len(line.encode()) <= 75:
+        return line
+    parts, part, size = [], '', 0
+    for character in line:
+        width = len(character.encode())
+        if size + width > 75:
+            parts.append(part)
+            # the space starting each continuation line is part of its 75
+            part, size = ' ', 1
+        part += character
+        size += width
+    parts.append(part)
+    return '\r\n'.join(parts)
@@ -0,0 +1,160 @@
+import time
+import queue
+import random
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# HTTP statuses the Calendar API returns for rate limiting and server errors,
+# which are worth trying again after a short wait
+RETRY_STATUSES = {403, 429, 500, 502, 503, 504}
+
+
+class BatchWriter:
+    '''
+    Groups Google calendar writes into batch requests and sends several
+    batches at once.
+
+    Each item is a (method, kwargs) pair for the events collection, e.g.
+    ('insert', {'calendarId': ..., 'body': {...}}) or
+    ('delete', {'calendarId': ..., 'eventId': ...}). Items which fail with a
+    rate limit or server error are retried on their own with exponential
+    backoff; anything still failing is handed back to the caller so that only
+    those items need to be sent again.
+
+    The worker threads and their connections are kept between writes, so a
+    long-running process (e.g. the daemon) doesn't set them up again for
+    every upload. close() stops the workers.
+    '''
+
+    def __init__(self, service, batch_size=50, max_workers=4, max_retries=5,
+                 backoff=1.0, http_factory=None, on_success=None, sleep=time.sleep):
+        self.service = service
+        self.batch_size = batch_size  # the Calendar API accepts up to 50 calls per batch
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_success = on_success
+        self.sleep = sleep
+
+        # httplib2 connections can't be shared between threads, so without a
+        # way to create a connection for each batch in flight only one batch
+        # is sent at a time over the service's own connection
+        self.http_factory = http_factory
+        self.max_workers = max_workers if http_factory else 1
+        self._connections = queue.LifoQueue()  # idle connections, most recently used first
+        self._pool = None
+
+    def write(self, items, on_success=None):
+        '''
+        Sends all items, returning a list of (item, error) for any which failed.
+        items can be any iterable, e.g. a generator, and are only read as fast
+        as they can be sent. on_success, if given, is called instead of the
+        writer's own with each item that goes through.
+        '''
+        on_success = on_success or self.on_success
+        failed = []
+
+        retry = self.send(items, failed, on_success)
+        for attempt in range(1, self.max_retries + 1):
+            if not retry:
+                break
+            # back off exponentially, with some jitter so retried
+            # batches from different workers don't arrive together
+            self.sleep(self.backoff * 2 ** (attempt - 1) * (1 + random.random()))
+            metrics.count('api retries', len(retry))
+            retry = self.send([item for item, _ in retry], failed, on_success)
+
+        # anything still waiting to be retried after the final attempt
+        return failed + retry
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def send(self, items, failed, on_success=None):
+        '''
+        Sends items in batches, adding errors which aren't worth retrying to
+        failed, and returns the (item, error) pairs to try again
+        '''
+        items = iter(items)
+        retry = []
+        in_flight = deque()
+        while True:
+            batch = list(itertools.islice(items, self.batch_size))
+            if batch:
+                in_flight.append(self.pool.submit(self.execute_batch, batch))
+            # once each worker has a batch waiting, the oldest is finished
+            # before any more items are read
+            if in_flight and (not batch or len(in_flight) >= 2 * self.max_workers):
+                succeeded, batch_retry, errors = in_flight.popleft().result()
+                if on_success:
+                    for item in succeeded:
+                        on_success(item)
+                retry.extend(batch_retry)
+                failed.extend(errors)
+            elif not batch:
+                return retry
+
+    def execute_batch(self, items):
+        '''Sends one batch request, sorting its items by how they fared'''
+        exceptions = {}
+
+        def callback(request_id, response, exception):
+            exceptions[request_id] = exception
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for i, (method, kwargs) in enumerate(items):
+            request = getattr(self.service.events(), method)(**kwargs)
+            batch.add(request, request_id=str(i))
+            metrics.count(f'api {method}')
+        metrics.count('api batches')
+
+        http = self.checkout()
+        try:
+            batch.execute(http=http)
+        except Exception as e:
+            # the whole batch failed to send, so every item is tried again
+            return [], [(item, e) for item in items], []
+        finally:
+            self.checkin(http)
+
+        succeeded, retry, errors = [], [], []
+        for i, item in enumerate(items):
+            exception = exceptions.get(str(i))
+            if exception is None:
+                succeeded.append(item)
+            elif status_of(exception) in RETRY_STATUSES or status_of(exception) is None:
+                retry.append((item, exception))
+            else:
+                errors.append((item, exception))
+
+        return succeeded, retry, errors
+
+    def checkout(self):
+        '''An idle connection, or a new one if they're all in use'''
+        if self.http_factory is None:
+            return None
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            metrics.count('api connections')
+            return self.http_factory()
+
+    def checkin(self, http):
+        if http is not None:
+            self._connections.put(http)
+
+
+def status_of(exception):
+    '''HTTP status of an API error, or None if the request never got a response'''
+    resp = getattr(exception, 'resp', None)
+    return getattr(resp, 'status', None)
@@ -0,0 +1,86 @@
+'''
+Measures how long the CLI takes to start, so slow imports creeping back into
+the startup path show up.
+
+Run from the repository root:
+
+    python benchmarks/startup.py --runs 10 --max-ms 300
+
+Each stage is run in a fresh interpreter, and the median wall-clock time is
+reported. With --max-ms the script exits with an error if importing the
+interface (everything before the first prompt) takes longer than that.
+'''
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# code run in a fresh interpreter for each stage of startup
+STAGES = {
+    'python': 'pass',
+    'import interface': 'import interface',
+    'list experiments': 'import interface; interface.list_experiments()',
+    # read only, so the real schedule isn't converted or frozen
+    'load schedule': 'from schedule import Calendar; Calendar().initialise_schedule(read_only=True)',
+}
+
+
+def time_stage(code, runs):
+    timer = ('import time; _start = time.perf_counter()\n'
+             f'{code}\n'
+             'print(time.perf_counter() - _start)')
+    times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', timer], cwd=ROOT,
+                                capture_output=True, text=True, check=True)
+        times.append(float(result.stdout.strip().splitlines()[-1]) * 1000)
+    return statistics.median(times)
+
+
+def slowest_imports(count=10):
+    '''The modules taking the longest to import, from python -X importtime'''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import interface'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines()[1:]:
+        _, self_time, cumulative, name = [part.strip() for part in line.replace(':', '|').split('|')]
+        imports.append((int(cumulative) / 1000, name))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-ms', type=float, help='fail if importing the interface takes longer')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for stage, code in STAGES.items():
+        try:
+            results[stage] = time_stage(code, args.runs)
+        except subprocess.CalledProcessError as e:
+            print(f'{stage}: failed\n{e.stderr}')
+            continue
+        print(f'{stage:<20} {results[stage]:8.1f} ms')
+
+    if 'import interface' in results:
+        print('\nSlowest imports of the interface (cumulative ms):')
+        for milliseconds, name in slowest_imports():
+            print(f'{milliseconds:8.1f}  {name}')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.max_ms and results.get('import interface', 0) > args.max_ms:
+        print(f"\nImporting the interface took {results['import interface']:.1f} ms, more than {args.max_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
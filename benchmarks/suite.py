@@ -0,0 +1,255 @@
+'''
+Times the scheduler, the saved schedule and the calendar sync on synthetic
+workloads, so slowdowns show up as the number of experiments grows.
+
+Run from the repository root:
+
+    python benchmarks/suite.py --sizes 5 50 500 5000 --json results.json
+
+For each size a fresh schedule is built in a temporary directory from a
+random mix of daily, weekly and monthly experiments, most starting within a
+few weeks of each other so there are plenty of collisions to solve. The
+instruments are given just enough capacity for the busiest weeks to fit. The
+stages timed are:
+
+    compile   Experiment.get_schedule for every experiment
+    add_many  Calendar.add_many with all but one of the experiments
+    solve     the Calendar.correct_collisions part of that
+    save      the part of it writing the schedule
+    load      reading the schedule back in a new Calendar
+    sync      the first Google_update, against an in-memory calendar backend
+              (or with --backend ics, .ics files)
+    add       adding one more experiment at the top, solve and save included
+    resync    the Google_update after that
+
+The API calls made by each sync are counted too. With --baseline the
+timings are compared with an earlier --json file, and the script exits with
+an error if any stage got more than --max-slowdown times slower.
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import contextlib
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from backends import get_backend  # noqa: E402
+from experiment import Experiment  # noqa: E402
+from horizon import WINDOW_DAYS, extend_repeat  # noqa: E402
+from schedule import Calendar  # noqa: E402
+
+SIZES = [5, 50, 500, 5000]
+INSTRUMENTS = 4
+# fraction of the weekday slots the experiments take up at the busiest time
+UTILISATION = 0.9
+
+
+class Timer:
+    '''Collects the time spent in each stage, in seconds'''
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + time.perf_counter() - start
+
+    def wrap(self, obj, method, name):
+        '''Times every call of one of obj's methods as the stage `name`'''
+        function = getattr(obj, method)
+
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        setattr(obj, method, timed)
+
+
+def workload(count, first_day, rng):
+    '''
+    Experiment settings for `count` experiments: (label, days, weeks,
+    months, start date). Most start within three weeks of first_day.
+    '''
+    patterns = [
+        lambda: (rng.randint(5, 20), 0, '0'),  # daily
+        lambda: (rng.randint(1, 5), rng.randint(4, 12), '0'),  # weekly
+        lambda: (rng.randint(1, 3), rng.randint(0, 4), str(rng.randint(3, 12))),  # monthly
+        lambda: (rng.randint(1, 3), rng.randint(0, 4), 'end'),  # until the end
+    ]
+    settings = []
+    for number in range(count):
+        spread = 21 if rng.random() < 0.8 else 180
+        start = first_day + datetime.timedelta(days=rng.randrange(spread))
+        while start.weekday() > 4:
+            start += datetime.timedelta(days=1)
+        days, weeks, months = rng.choice(patterns)()
+        settings.append((f'exp{number:05d}', days, weeks, months, start.strftime('%d/%m/%y')))
+    return settings
+
+
+def build_experiment(label, days, weeks, months, start_date):
+    experiment = Experiment()
+    experiment.label = label
+    experiment.days = days
+    experiment.weeks = weeks
+    experiment.months = months
+    experiment.start_date = start_date
+    return experiment
+
+
+def write_instruments(experiments):
+    '''
+    Instruments with just enough capacity to take the experiments' tests in
+    the busiest four weeks of the schedule
+    '''
+    first = min(experiment.time_elapsed for experiment in experiments)
+    tests = np.zeros(WINDOW_DAYS + max(experiment.last_test for experiment in experiments) - first + 1)
+    for experiment in experiments:
+        days = experiment.measurement_days
+        if experiment.repeat:
+            days = extend_repeat(days, experiment.repeat, first + WINDOW_DAYS)
+        np.add.at(tests, days - first, 1)
+    busiest = np.convolve(tests, np.ones(28), 'valid').max() / 20  # tests per weekday
+    capacity = max(int(np.ceil(busiest / (INSTRUMENTS * UTILISATION))), 1)
+
+    instruments = [{'name': f'Instrument {number}', 'type': 'potentiostat', 'capacity': capacity,
+                    'calendar_id': f'instrument{number}@example.com'} for number in range(INSTRUMENTS)]
+    with open('instruments.json', 'w') as file:
+        json.dump(instruments, file)
+    return capacity
+
+
+def new_calendar(backend, solver, solver_options):
+    return Calendar(solver=solver, backend=backend, **solver_options)
+
+
+def sync(calendar, timer, name):
+    service = calendar.backend.service
+    calls, round_trips = service.calls.copy(), service.round_trips
+    with timer.stage(name):
+        calendar.Google_update()
+    return {'calls': dict(service.calls - calls), 'round_trips': service.round_trips - round_trips}
+
+
+def run(count, seed, solver, solver_options, latency, backend_name):
+    rng = random.Random(seed)
+    timer = Timer()
+    backend = get_backend(backend_name, latency=latency, sleep=lambda seconds: None)
+    today = datetime.date.today()
+    settings = workload(count, today + datetime.timedelta(days=1), rng)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        with timer.stage('compile'):
+            experiments = [build_experiment(*setting) for setting in settings]
+        capacity = write_instruments(experiments[1:])
+
+        calendar = new_calendar(backend, solver, solver_options)
+        timer.wrap(calendar, 'correct_collisions', 'solve')
+        timer.wrap(calendar, 'save_dataframe', 'save')
+        with timer.stage('add_many'):
+            calendar.add_many(experiments[1:])
+        # loading an empty schedule isn't interesting, so load is timed afresh
+        calendar = new_calendar(backend, solver, solver_options)
+        with timer.stage('load'):
+            calendar.calendar
+        api = {'sync': sync(calendar, timer, 'sync')}
+
+        calendar = new_calendar(backend, solver, solver_options)
+        with timer.stage('add'):
+            calendar.add(experiments[0])
+        api['resync'] = sync(calendar, timer, 'resync')
+
+        tests = calendar.calendar.total()
+        os.chdir(ROOT)
+
+    return {
+        'experiments': count,
+        'tests': tests,
+        'capacity': capacity,
+        'timings': timer.timings,
+        'api': api,
+    }
+
+
+def compare(results, baseline_path, max_slowdown):
+    '''Lists the stages which took more than max_slowdown times longer than in the baseline'''
+    with open(baseline_path, 'r') as file:
+        baseline = {result['experiments']: result['timings'] for result in json.load(file)['results']}
+
+    slower = []
+    for result in results:
+        previous = baseline.get(result['experiments'], {})
+        for stage, seconds in result['timings'].items():
+            if stage in previous and seconds > max_slowdown * previous[stage]:
+                slower.append(f"{result['experiments']} experiments, {stage}: "
+                              f'{seconds * 1000:.1f} ms, was {previous[stage] * 1000:.1f} ms')
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--solver', default='heuristic')
+    parser.add_argument('--time-budget', type=float, help='for the assignment solver')
+    parser.add_argument('--backend', choices=['memory', 'ics'], default='memory')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per fake API round trip')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results in this file')
+    parser.add_argument('--max-slowdown', type=float, default=1.5)
+    args = parser.parse_args()
+
+    solver_options = {}
+    if args.time_budget is not None:
+        solver_options['time_budget'] = args.time_budget
+
+    results = []
+    for count in args.sizes:
+        # the program's own output (progress bars etc.) isn't wanted here
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            result = run(count, args.seed, args.solver, solver_options, args.latency, args.backend)
+        results.append(result)
+
+        timings = '  '.join(f'{stage} {seconds * 1000:.1f}' for stage, seconds in result['timings'].items())
+        calls = sum(result['api']['sync']['calls'].values())
+        print(f"{count:>6} experiments, {result['tests']:>7} tests (ms): {timings}  "
+              f"[{calls} API calls in {result['api']['sync']['round_trips']} round trips]")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'solver': args.solver,
+                'seed': args.seed,
+                'backend': args.backend,
+                'latency': args.latency,
+                'results': results,
+            }, file, indent=2)
+
+    if args.baseline:
+        slower = compare(results, args.baseline, args.max_slowdown)
+        if slower:
+            print(f'\nSlower than {args.baseline} by more than {args.max_slowdown}x:')
+            print('\n'.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
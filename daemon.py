@@ -0,0 +1,266 @@
+import io
+import os
+import sys
+import json
+import copy
+import socket
+import datetime
+import threading
+import traceback
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+
+import metrics
+
+SOCKET_PATH = os.path.join('schedule', 'daemon.sock')
+
+
+class DaemonUnavailable(Exception):
+    '''Raised by the client when there's no daemon listening on the socket'''
+
+
+class SchedulerDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Long-running scheduler which keeps a Calendar - its loaded schedule and
+    calendar backend, e.g. the authorised Google service - between commands,
+    so each add, delete, list or what-if doesn't pay for setting them up.
+
+    Each request is a line of JSON, {"command": ..., "options": {...},
+    "arguments": {...}}, where options are the Calendar's solver options.
+    Anything the command prints is sent back as {"output": ...} lines while
+    it runs, followed by {"status": exit code, "metrics": {...}}.
+
+    Requests are served one at a time, in the order they arrive, so several
+    people can queue changes without them getting mixed up.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET_PATH):
+        self.path = path
+        self.calendars = {}  # solver options -> Calendar
+        self.lock = threading.Lock()
+        # when the saved schedule was last known to be loaded, to notice
+        # changes made by anything other than the daemon
+        self.state = None
+        super().__init__(path, RequestHandler)
+        # anyone in the group (e.g. the lab) can send commands
+        os.chmod(path, 0o660)
+
+    def calendar(self, options):
+        from schedule import Calendar
+
+        key = json.dumps(options, sort_keys=True)
+        if key not in self.calendars:
+            self.calendars[key] = Calendar(**options)
+        return self.calendars[key]
+
+    def check_schedule(self):
+        '''
+        Reloads the schedules if they've been changed on disk by another
+        process, or if the day has changed so past days need freezing
+        '''
+        state = self.schedule_state()
+        if self.state is not None and state != self.state:
+            for calendar in self.calendars.values():
+                calendar.reload()
+        self.state = state
+
+    def schedule_state(self):
+        from storage import ScheduleStore
+
+        store = ScheduleStore()
+        modified = os.stat(store.index_path).st_mtime_ns if store.exists() else None
+        return modified, datetime.date.today()
+
+    def execute(self, request, output):
+        '''
+        Runs a request, returning its exit code and metrics (taken before the
+        next request can reset them)
+        '''
+        with self.lock:
+            self.check_schedule()
+            metrics.reset()
+            try:
+                with redirect_stdout(output), redirect_stderr(output):
+                    execute(self, request['command'], request.get('options', {}),
+                            request.get('arguments', {}))
+            except SystemExit as e:
+                # as the interpreter would on exiting
+                if isinstance(e.code, str):
+                    output.write(e.code + '\n')
+                status = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                output.write(traceback.format_exc())
+                status = 1
+            else:
+                status = 0
+            if status != 0:
+                # a failed add may have left its experiments in the loaded
+                # schedule without saving them, so they're read again
+                for calendar in self.calendars.values():
+                    calendar.reload()
+            # the daemon's own changes don't need the schedule reloading
+            self.state = self.schedule_state()
+            return status, metrics.snapshot()
+
+    def server_close(self):
+        super().server_close()
+        for calendar in self.calendars.values():
+            calendar.backend.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        if request['command'] == 'ping':
+            self.send(status=0)
+            return
+        if request['command'] == 'shutdown':
+            self.send(status=0)
+            # shutdown() waits for serve_forever() to stop, so can't be called from its thread
+            threading.Thread(target=self.server.shutdown).start()
+            return
+
+        status, snapshot = self.server.execute(request, SocketOutput(self))
+        self.send(status=status, metrics=snapshot)
+
+    def send(self, **message):
+        try:
+            self.wfile.write((json.dumps(message) + '\n').encode())
+            self.wfile.flush()
+        except OSError:
+            # the client has gone, but the command carries on regardless so
+            # uploads aren't left half done
+            pass
+
+
+class SocketOutput(io.TextIOBase):
+    '''Text stream sending whatever a command prints back to the client'''
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError(f'write() argument must be str, not {type(text).__name__}')
+        if text:
+            self.handler.send(output=text)
+        return len(text)
+
+
+def execute(server, command, options, arguments):
+    '''Runs one of the commands the daemon serves'''
+    import interface
+
+    if command == 'add':
+        experiments, errors = interface.build_experiments(arguments['rows'])
+        if errors:
+            print('No experiments were added, as they have errors:')
+            for error in errors:
+                print(f'• {error}')
+            raise SystemExit(1)
+        experiments.sort(key=lambda exp: exp.priority)
+        interface.add_experiments(server.calendar(options), experiments)
+
+    elif command == 'delete':
+        server.calendar(options).clear_calendar(arguments['label'], cli=True)
+
+    elif command == 'list':
+        interface.list_experiments()
+
+    elif command == 'whatif':
+        from whatif import score_start_dates
+
+        exp = interface.whatif_experiment(**{key: arguments[key] for key in
+                                             ('days', 'weeks', 'months', 'instrument', 'instrument_type')})
+        first, last = (datetime.date.fromisoformat(arguments[key]) for key in ('first', 'last'))
+        suggestions = score_start_dates(scratch_copy(server.calendar(options)), exp, first, last,
+                                        arguments.get('workers'))
+        interface.show_suggestions(suggestions, arguments['top'])
+
+    else:
+        raise ValueError(f'Unknown command: {command}')
+
+
+def scratch_copy(calendar):
+    '''
+    A copy of a Calendar whose schedule can be changed (e.g. its window
+    lengthened) without changing the original, sharing its service
+    '''
+    scratch = copy.copy(calendar)
+    scratch.calendar = copy.deepcopy(calendar.calendar)
+    scratch.repeats = dict(calendar.repeats)
+    scratch.assignments = dict(calendar.assignments)
+    return scratch
+
+
+def serve(path=SOCKET_PATH, **options):
+    '''
+    Runs the daemon until it's stopped, first loading the schedule and
+    connecting to the calendar backend (e.g. authorising with Google) so the
+    first command doesn't wait for them
+    '''
+    if available(path):
+        raise RuntimeError(f'A scheduler daemon is already listening on {path}')
+    if os.path.exists(path):
+        # left behind by a daemon which didn't shut down cleanly
+        os.remove(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    server = SchedulerDaemon(path)
+    try:
+        calendar = server.calendar(options)
+        calendar.calendar
+        calendar.backend.connect()
+        server.state = server.schedule_state()
+        print(f'Scheduler daemon listening on {path}')
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def connect(path=SOCKET_PATH):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise DaemonUnavailable('Unix sockets are not supported on this system')
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        connection.close()
+        raise DaemonUnavailable(str(e))
+    return connection
+
+
+def available(path=SOCKET_PATH):
+    '''Whether a daemon is listening on the socket'''
+    try:
+        return request('ping', path=path) == 0
+    except DaemonUnavailable:
+        return False
+
+
+def request(command, options=None, arguments=None, path=SOCKET_PATH, output=None):
+    '''
+    Sends a command to the daemon, writing what it prints to output (stdout
+    by default) as it arrives, and returns the command's exit code. The
+    daemon's timings and counts are added to this process's metrics.
+    Raises DaemonUnavailable if no daemon is running.
+    '''
+    output = output or sys.stdout
+    with connect(path) as connection:
+        message = {'command': command, 'options': options or {}, 'arguments': arguments or {}}
+        connection.sendall((json.dumps(message) + '\n').encode())
+        for line in connection.makefile('r', encoding='utf-8'):
+            reply = json.loads(line)
+            if 'output' in reply:
+                output.write(reply['output'])
+                output.flush()
+            elif 'status' in reply:
+                metrics.merge(reply.get('metrics', {}))
+                return reply['status']
+    # the command may have been partly carried out, so it mustn't be run again
+    raise RuntimeError('The scheduler daemon stopped before the command finished')
@@ -0,0 +1,170 @@
+import os
+import json
+import datetime
+
+import numpy as np
+
+import metrics
+from batch import status_of
+from horizon import day_offset
+from storage import atomic_write
+from sync import event_id
+
+
+class EventCache:
+    '''
+    Local copy of the events in each Google calendar.
+
+    The first refresh of a calendar lists all of its events, and later ones
+    pass the sync token from the previous refresh so only the events created,
+    changed or deleted since are sent. If Google no longer accepts the token
+    (410 Gone) the calendar is listed in full again.
+
+    Events are kept as the day offsets they cover, [first, last), and whether
+    they're one of this program's measurements or a booking someone made
+    directly in Google Calendar. Recurring events are listed as their
+    occurrences, each noting the ID of the recurring event as its series.
+    '''
+
+    def __init__(self, path=os.path.join('schedule', 'events.json')):
+        self.path = path
+        self._calendars = None
+        self._series = {}  # calendarId -> IDs of the recurring events with occurrences
+
+    @property
+    def calendars(self):
+        '''calendarId -> {'sync_token': ..., 'events': {eventId: event}, 'backend': name}'''
+        if self._calendars is None:
+            self._calendars = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as file:
+                    self._calendars = json.load(file)
+        return self._calendars
+
+    def synced(self, calendar_id):
+        return calendar_id in self.calendars
+
+    def refresh(self, backend, calendar_id, known=()):
+        '''
+        Brings a calendar's events up to date from a CalendarBackend,
+        returning the number of changes. known is the IDs of events this
+        program is known to have written, which are never external bookings
+        even without the experiment marker (e.g. ones uploaded by older
+        versions of the program).
+        '''
+        calendar = self.calendars.get(calendar_id)
+        # events cached from another backend, e.g. before changing to .ics
+        # files, are listed again (caches older than backends were Google's)
+        if calendar is not None and calendar.get('backend', 'google') != backend.name:
+            calendar = None
+        try:
+            changes = self.list_changes(backend, calendar_id, calendar)
+        except Exception as e:
+            if calendar is None or status_of(e) != 410:
+                raise
+            calendar = None
+            changes = self.list_changes(backend, calendar_id, calendar)
+
+        for eventID, event in self.calendars[calendar_id]['events'].items():
+            if event['external'] and eventID in known:
+                event['external'] = False
+        self._series.pop(calendar_id, None)
+        self.save()
+        return changes
+
+    def list_changes(self, backend, calendar_id, calendar):
+        if calendar is None:
+            calendar = self.calendars[calendar_id] = {'sync_token': None, 'events': {}, 'backend': backend.name}
+            metrics.count('event cache full syncs')
+
+        events = calendar['events']
+        changed, sync_token = backend.list(calendar_id, calendar['sync_token'])
+        for event in changed:
+            if event.get('status') == 'cancelled':
+                events.pop(event['id'], None)
+            else:
+                events[event['id']] = event_days(event)
+
+        calendar['sync_token'] = sync_token
+        metrics.count('event cache changes', len(changed))
+        return len(changed)
+
+    def save(self):
+        if self._calendars is None:
+            return
+        with atomic_write(self.path) as file:
+            json.dump(self.calendars, file)
+
+    def has_event(self, calendar_id, event_id, date):
+        '''
+        Whether an event is in the calendar on a day offset (its first, for a
+        recurring event), as far as the cache knows
+        '''
+        event = self.calendars.get(calendar_id, {}).get('events', {}).get(event_id)
+        if event is not None and event['first'] == date:
+            return True
+        return event_id in self.series(calendar_id)
+
+    def series(self, calendar_id):
+        if calendar_id not in self._series:
+            self._series[calendar_id] = {event.get('series') for event in
+                                         self.calendars.get(calendar_id, {}).get('events', {}).values()}
+        return self._series[calendar_id]
+
+    def record(self, calendar_id, inserted=(), deleted=()):
+        '''
+        Notes the measurements this program has just (label, day offset, event
+        ID) inserted or (event ID) deleted, so the cache doesn't need a refresh
+        to know about them
+        '''
+        if not self.synced(calendar_id):
+            return
+        events = self.calendars[calendar_id]['events']
+        for label, date, eventID in inserted:
+            events[eventID] = {'summary': label, 'first': date, 'last': date + 1, 'external': False}
+        for eventID in deleted:
+            events.pop(eventID, None)
+        # along with the occurrences of recurring events
+        series = self.series(calendar_id)
+        gone = series.intersection(deleted)
+        if gone:
+            for eventID in [eventID for eventID, event in events.items() if event.get('series') in gone]:
+                del events[eventID]
+            series -= gone
+
+    def bookings(self, calendar_id, first, last):
+        '''Number of external bookings on each day offset in [first, last)'''
+        counts = np.zeros(max(last - first, 0))
+        for event in self.calendars.get(calendar_id, {}).get('events', {}).values():
+            if event['external'] and event['first'] < last and event['last'] > first:
+                counts[max(event['first'], first) - first:min(event['last'], last) - first] += 1
+        return counts
+
+
+def event_days(event):
+    '''
+    The cached form of an event: the day offsets it covers and whether it
+    was booked outside this program
+    '''
+    first, last = (event_date(event.get(key, {})) for key in ('start', 'end'))
+    start = day_offset(first)
+    # all-day events and events ending at midnight don't take up their last day
+    if 'date' in event.get('end', {}) or event.get('end', {}).get('dateTime', '')[11:16] in ('', '00:00'):
+        end = day_offset(last)
+    else:
+        end = day_offset(last) + 1
+    end = max(end, start + 1)
+
+    summary = event.get('summary', '')
+    # this program's events are marked with the experiment, and older ones
+    # have IDs made from the experiment and date
+    experiment = event.get('extendedProperties', {}).get('private', {}).get('experiment')
+    external = experiment != summary and event['id'] != event_id(summary, first.strftime('%d/%m/%y'))
+    days = {'summary': summary, 'first': start, 'last': end, 'external': external}
+    if event.get('recurringEventId'):
+        days['series'] = event['recurringEventId']
+    return days
+
+
+def event_date(moment):
+    return datetime.datetime.strptime((moment.get('date') or moment['dateTime'])[:10], '%Y-%m-%d').date()
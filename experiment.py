@@ -1,15 +1,23 @@
-import os
 import re
 import datetime
-import numpy as np
+
+from horizon import day_offset
+from instruments import load_instruments
+from recurrence import MONTH, compile_schedules
+from storage import ScheduleStore
 
 
 class Experiment:
 
     def __init__(self):
-        # look at existing experiment files, ignoring anything hidden
-        self._experiment_files = [f for f in os.listdir('experiment_dates') if not f.startswith('.')]
-        self.num_of_experiments = len(self._experiment_files)
+        # look at the experiments already scheduled
+        self._existing_labels = ScheduleStore().labels()
+        self.num_of_experiments = len(self._existing_labels)
+        self._priority = 1
+        # the instrument to book, or the type of instrument to pick one from -
+        # any instrument if neither is given
+        self.instrument = None
+        self.instrument_type = None
 
     @property
     def label(self):
@@ -18,11 +26,38 @@ class Experiment:
     @label.setter
     def label(self, label_input):
         # ensure experiment label doesn't match previous experiments
-        if label_input in self._experiment_files:
+        if label_input in self._existing_labels:
             raise ValueError("\nERROR: Experiment with this name already exists!")
         else:
             self._label = label_input
 
+    @property
+    def days(self):
+        return self._days
+
+    @days.setter
+    def days(self, days_input):
+        self._days = whole_number(days_input, 'daily measurements')
+
+    @property
+    def weeks(self):
+        return self._weeks
+
+    @weeks.setter
+    def weeks(self, weeks_input):
+        self._weeks = whole_number(weeks_input, 'weekly measurements')
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @priority.setter
+    def priority(self, priority_input):
+        # 1 is the highest priority
+        self._priority = whole_number(priority_input, 'priority')
+        if self._priority < 1:
+            raise ValueError('\nERROR: Priority must be 1 or more.')
+
     @property
     def months(self):
         return self._months
@@ -58,46 +93,27 @@ class Experiment:
     def get_schedule(self):
         """Takes CLI input and returns schedule for that experiment"""
 
-        # mark the 'beginning' of the calender as the first monday of 2018
-        beginning = datetime.datetime(2018, 1, 1)
         # the time (in days) elapsed since the beginning of the calendar (1/1/2018)
-        time_elapsed = self.start_date - beginning
-        self.time_elapsed = time_elapsed.days
-
-        tests = np.zeros(365)
-
-        saturdays = np.arange(5, 365, 7)
-        sundays = saturdays + 1
-        # lists the day values which are weekends
-        weekends = np.concatenate((saturdays, sundays))
-
-        tests[self.time_elapsed] = 1  # create the first experiment
-
-        tests[self.time_elapsed: self.time_elapsed + self.days] = 1  # create tests
-        tests[weekends] = 0  # cancel any tests which were scheduled over a weekend
-
-        # assign experiments based on week values provided
-        if self.weeks:
-            # find last test schedule in previous step
-            last_test = max(tests.nonzero()[0])
-            # if last test was on a friday, the beginning of the weekly tests will
-            # be the following monday
-            last_test = self.time_elapsed + 7 if\
-                ((last_test - 4) % 7) == 0 else last_test
-            tests[last_test: (last_test + self.weeks * 7) + 1: 7] = 1
-
-        try:
-            months = int(self.months)  # convert months from inputted string
-            last_test = max(tests.nonzero()[0])
-            # will treat months as 4 weeks
-            tests[last_test: (last_test + months * 28) + 1: 28] = 1
-
-        except ValueError:
-            # asigns zero value if nothing entered for days
-            if self.months == 'end':
-                tests[(days - 1)::28] = 1
-            last_test = max(tests.nonzero()[0])
-            self.last_test = last_test
-            print('final')
-
-        self.measurement_days = tests
+        self.time_elapsed = day_offset(self.start_date)
+        months = 0 if self.months == 'end' else int(self.months)
+
+        # no daily tests are booked while the chosen instrument is out of action
+        closed_days = ()
+        if self.instrument:
+            closed_days = load_instruments()[self.instrument].closed_days
+
+        # absolute day offsets of every measurement
+        self.measurement_days = compile_schedules([self.time_elapsed], [self.days], [self.weeks],
+                                                  [months], closed_days=closed_days)[0]
+        self.last_test = self.measurement_days[-1]
+
+        # experiments running until the 'end' carry on with monthly tests for
+        # as far ahead as the calendar is scheduled
+        self.repeat = MONTH if self.months == 'end' else None
+
+
+def whole_number(value, name):
+    """Converts value to a non-negative int, raising ValueError if it isn't one"""
+    if not re.search(r'^\d+$', str(value).strip()):
+        raise ValueError(f'\nERROR: Please enter a whole number for {name}.')
+    return int(value)
@@ -0,0 +1,46 @@
+import datetime
+
+import numpy as np
+
+# all days are counted from the beginning of the calendar, the first monday of 2018
+EPOCH = datetime.date(2018, 1, 1)
+# the active scheduling window covers at least this many days from today
+WINDOW_DAYS = 365
+
+
+def day_offset(date):
+    '''Number of days from the beginning of the calendar to date'''
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    return (date - EPOCH).days
+
+
+def offset_date(offset):
+    return EPOCH + datetime.timedelta(days=int(offset))
+
+
+def iso_dates(offsets):
+    '''YYYY-MM-DD strings for an array of day offsets, converted all at once'''
+    return (np.datetime64(EPOCH, 'D') + np.asarray(offsets, dtype=np.int64)).astype(str)
+
+
+def weekend_mask(offsets):
+    '''True for the day offsets which fall on a saturday or sunday'''
+    return np.asarray(offsets) % 7 >= 5
+
+
+def window_days(start, experiments, minimum=WINDOW_DAYS):
+    '''
+    Length of the active window beginning at start: at least `minimum` days,
+    and long enough to hold the last measurement of every experiment.
+    '''
+    last = max([int(days[-1]) for days in experiments if len(days)] + [start])
+    return max(minimum, last - start + 1)
+
+
+def extend_repeat(offsets, repeat, end):
+    '''Continues a measurement every `repeat` days from the last one until end'''
+    if not len(offsets):
+        return offsets
+    extra = np.arange(int(offsets[-1]) + repeat, end, repeat, dtype=offsets.dtype)
+    return np.concatenate((offsets, extra))
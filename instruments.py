@@ -0,0 +1,96 @@
+import os
+import json
+import datetime
+from collections import OrderedDict
+
+import numpy as np
+
+from horizon import day_offset
+
+# used when there's no instruments.json: the single Solartron the program
+# was originally written for
+DEFAULT_INSTRUMENTS = [{
+    'name': 'Solartron',
+    'type': 'potentiostat',
+    'capacity': 1,
+    'calendar_id': 'nllc88qbvtkks5a7jquivl9ibc@group.calendar.google.com',
+    'location': 'IDG Room 116A',
+}]
+
+
+class Instrument:
+    '''
+    A piece of equipment experiments can be booked on.
+
+    capacity is the number of batches of samples it can measure each day.
+    capacity_changes maps dates (dd/mm/yy) to a different capacity for that
+    day, e.g. 0 while it's being serviced.
+    '''
+
+    def __init__(self, name, type, calendar_id, capacity=1, location='', capacity_changes=None):
+        self.name = name
+        self.type = type
+        self.calendar_id = calendar_id
+        self.capacity = capacity
+        self.location = location
+        self.capacity_changes = OrderedDict(
+            (day_offset(datetime.datetime.strptime(date, '%d/%m/%y')), capacity)
+            for date, capacity in (capacity_changes or {}).items())
+
+    @property
+    def closed_days(self):
+        '''Day offsets when the instrument can't be used at all'''
+        return tuple(day for day, capacity in self.capacity_changes.items() if capacity < 1)
+
+    def capacity_vector(self, days):
+        '''Number of batches which can be measured on each of the day offsets given'''
+        days = np.asarray(days)
+        capacity = np.full(len(days), self.capacity, dtype=float)
+        if self.capacity_changes and len(days):
+            changes = np.array(list(self.capacity_changes.items()))
+            in_window = (changes[:, 0] >= days[0]) & (changes[:, 0] <= days[-1])
+            capacity[changes[in_window, 0] - days[0]] = changes[in_window, 1]
+        return capacity
+
+
+def load_instruments(path='instruments.json'):
+    '''Returns an OrderedDict of instrument name -> Instrument'''
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            config = json.load(file)
+    else:
+        config = DEFAULT_INSTRUMENTS
+
+    return OrderedDict((item['name'], Instrument(**item)) for item in config)
+
+
+def candidate_instruments(instruments, name=None, type=None):
+    '''The instruments an experiment may be booked on'''
+    if name:
+        if name not in instruments:
+            raise ValueError(f'\nERROR: There is no instrument called {name}.')
+        return [name]
+
+    candidates = [instrument.name for instrument in instruments.values()
+                  if not type or instrument.type == type]
+    if not candidates:
+        raise ValueError(f'\nERROR: There are no instruments of type {type}.')
+    return candidates
+
+
+def least_loaded(candidates, occupancy, capacity, tests):
+    '''
+    Picks the instrument an experiment's tests fit best on.
+
+    occupancy and capacity are (instruments x days) arrays of the tests
+    booked and the tests allowed on each day, and tests is the experiment's
+    vector of tests per day. The instrument with the fewest of the
+    experiment's days already full wins, then the one with the most room
+    left over those days.
+    '''
+    headroom = capacity - occupancy
+    test_days = tests > 0
+    clashes = np.sum((headroom < 1) & test_days, axis=1)
+    room = np.sum(np.clip(headroom, 0, None) * test_days, axis=1)
+    # lexsort sorts by the last key first
+    return candidates[np.lexsort((-room, clashes))[0]]
@@ -1,46 +1,356 @@
 import os
+import csv
+import json
 import time
 import click
 import datetime
-from experiment import Experiment
-from schedule import Calendar
 
-
-@click.command()
-def main():
+# the scheduling and Google calendar modules are slow to import, so they're
+# only imported once an option which needs them has been chosen
+
+
+@click.group(invoke_without_command=True)
+@click.option('--solver', type=click.Choice(['heuristic', 'assignment']), default='heuristic',
+              help='How to reschedule experiments which collide.')
+@click.option('--backend', type=click.Choice(['google', 'ics', 'memory']), default='google',
+              help='Where to keep the events: the Google calendars, .ics files in '
+                   'schedule/calendars/ or (for trying things out) memory.')
+@click.option('--time-budget', type=float, default=5.0,
+              help='Seconds the assignment solver may spend improving its placement.')
+@click.option('--max-drift', type=int, default=28,
+              help='Furthest (in days) the assignment solver may move a measurement.')
+@click.option('--profile', is_flag=True,
+              help='Print how long each phase of the run took once it finishes.')
+@click.option('--profile-output', type=click.Path(dir_okay=False),
+              help='Also save a cProfile of the run to this file.')
+@click.option('--metrics', 'metrics_path', type=click.Path(dir_okay=False),
+              help="Append this run's timings and counts to this file, as a line of JSON.")
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False),
+              help='Socket of the scheduler daemon (see serve), by default schedule/daemon.sock.')
+@click.option('--no-daemon', is_flag=True,
+              help='Run in this process even if a scheduler daemon is running.')
+@click.pass_context
+def main(ctx, solver, backend, time_budget, max_drift, profile, profile_output, metrics_path, socket_path, no_daemon):
     '''
     Walks through a command line interface which allows the use to
     manage a Google calendar listing experiments for a piece
     of equipment
     '''
+    if profile or profile_output or metrics_path:
+        start_profiling(ctx, profile, profile_output, metrics_path)
+
+    # commands are sent to the scheduler daemon, if one is running
+    ctx.meta['daemon'] = {'path': socket_path, 'disabled': no_daemon}
+    ctx.obj = {'solver': solver, 'backend': backend}
+    if solver == 'assignment':
+        ctx.obj.update(time_budget=time_budget, max_drift=max_drift)
+    if ctx.invoked_subcommand is not None:
+        return
+
     clear_screen()
 
-    calendar = Calendar()
     test = program_selection()
 
     # Add new experiment
     if test == '1':
         experiment = create_experiment()
-        calendar.add(experiment)
-        calendar.Google_update()
+        if not forward(ctx, 'add', rows=[experiment_row(experiment)]):
+            from schedule import Calendar
+            calendar = Calendar(**ctx.obj)
+            add_experiments(calendar, [experiment])
 
     # Delete experiment
     elif test == '2':
         exp_delete = delete_experiment()
-        calendar.clear_calendar(exp_delete, cli=True)
+        if not forward(ctx, 'delete', label=exp_delete):
+            from schedule import Calendar
+            Calendar(**ctx.obj).clear_calendar(exp_delete, cli=True)
+
+    # List experiments
+    elif test == '3':
+        if not forward(ctx, 'list'):
+            list_experiments()
+        return
 
     clear_screen()
 
 
+@main.command(name='import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def import_experiments(ctx, path):
+    '''
+    Adds every experiment listed in a CSV or JSON file, without prompting.
+
+    Each experiment needs a label and start_date (dd/mm/yy), and can have
+    days, weeks, months (a number or 'end'), priority (1 is highest) and
+    instrument or instrument_type.
+    CSV files need a header row with these names and JSON files a list of
+    objects with these keys. Nothing is changed unless every experiment is
+    valid, and collisions are solved and the calendar updated just once.
+    '''
+    rows = read_experiment_file(path)
+    experiments, errors = build_experiments(rows)
+    if errors:
+        click.echo('No experiments were added, as the file has errors:')
+        for error in errors:
+            click.echo(f'• {error}')
+        raise SystemExit(1)
+
+    if not forward(ctx, 'add', rows=rows):
+        from schedule import Calendar
+
+        # sort from highest to lowest priority, keeping the file order otherwise
+        experiments.sort(key=lambda exp: exp.priority)
+        add_experiments(Calendar(**ctx.obj), experiments)
+    click.echo(f'\nAdded {len(experiments)} experiments.')
+
+
+@main.command(name='serve')
+@click.option('--stop', is_flag=True, help='Stop the daemon which is running.')
+@click.pass_context
+def serve(ctx, stop):
+    '''
+    Runs the scheduler daemon, until stopped with Ctrl-C or serve --stop.
+
+    The daemon keeps the schedule loaded and the Google calendar service
+    authorised and connected, and the other commands are sent to it rather
+    than each starting from scratch. Commands sent by several people at once
+    are carried out one after another.
+    '''
+    import daemon
+
+    path = ctx.meta['daemon']['path'] or daemon.SOCKET_PATH
+    if stop:
+        try:
+            daemon.request('shutdown', path=path)
+        except daemon.DaemonUnavailable:
+            click.echo(f'No scheduler daemon is listening on {path}')
+            raise SystemExit(1)
+        return
+
+    try:
+        daemon.serve(path, **ctx.obj)
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        click.echo(e)
+        raise SystemExit(1)
+
+
+def forward(ctx, command, **arguments):
+    '''
+    Sends a command to the scheduler daemon, returning False if there's no
+    daemon to send it to so it has to be carried out in this process
+    '''
+    settings = ctx.meta['daemon']
+    if settings['disabled']:
+        return False
+
+    import daemon
+
+    try:
+        status = daemon.request(command, ctx.obj, arguments,
+                                path=settings['path'] or daemon.SOCKET_PATH)
+    except daemon.DaemonUnavailable:
+        return False
+    if status:
+        raise SystemExit(status)
+    return True
+
+
+def start_profiling(ctx, profile, profile_output, metrics_path):
+    '''
+    Starts timing the run (and profiling it, if profile_output is given),
+    reporting the results when the command finishes, however it finishes
+    '''
+    import metrics
+
+    profiler = None
+    if profile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_output)
+        if profile or profile_output:
+            click.echo(f'\n{metrics.report()}', err=True)
+            if profile_output:
+                click.echo(f'\nProfile saved to {profile_output}', err=True)
+        if metrics_path:
+            metrics.append_metrics(metrics_path, command=ctx.invoked_subcommand or 'interactive')
+
+    # close callbacks run last in first, so the run is timed before finishing
+    ctx.call_on_close(finish)
+    ctx.with_resource(metrics.timer('run'))
+
+
+@main.command(name='whatif')
+@click.option('--days', type=int, default=0, help='Daily measurements (days).')
+@click.option('--weeks', type=int, default=0, help='Weekly measurements (weeks).')
+@click.option('--months', default='0', help="Monthly measurements (months), or 'end'.")
+@click.option('--instrument', help='Instrument to book.')
+@click.option('--instrument-type', help='Type of instrument to book.')
+@click.option('--from', 'first', help='First start date to try (dd/mm/yy), by default today.')
+@click.option('--to', 'last', help='Last start date to try (dd/mm/yy), by default 13 weeks on.')
+@click.option('--top', type=int, default=10, help='Number of start dates to list.')
+@click.option('--workers', type=int, help='Processes to use, by default one per CPU.')
+@click.pass_context
+def what_if(ctx, days, weeks, months, instrument, instrument_type, first, last, top, workers):
+    '''
+    Suggests the start dates which disturb the existing schedule least,
+    without changing anything.
+
+    Every start date in the range is tried, and scored by how many of the
+    other experiments' measurements would move, how far they'd move and how
+    high priority those experiments are. Lower scores are better.
+    '''
+    try:
+        exp = whatif_experiment(days, weeks, months, instrument, instrument_type)
+        first = datetime.datetime.strptime(first, '%d/%m/%y').date() if first else datetime.date.today()
+        last = datetime.datetime.strptime(last, '%d/%m/%y').date() if last else first + datetime.timedelta(weeks=13)
+    except (ValueError, TypeError) as e:
+        click.echo(str(e).strip())
+        raise SystemExit(1)
+
+    if forward(ctx, 'whatif', days=days, weeks=weeks, months=months, instrument=instrument,
+               instrument_type=instrument_type, first=first.isoformat(), last=last.isoformat(),
+               top=top, workers=workers):
+        return
+
+    from schedule import Calendar
+    from whatif import score_start_dates
+
+    suggestions = score_start_dates(Calendar(**ctx.obj), exp, first, last, workers)
+    show_suggestions(suggestions, top)
+
+
+def whatif_experiment(days, weeks, months, instrument, instrument_type):
+    '''An Experiment with a schedule and instrument but no label or start date, for what-ifs'''
+    from experiment import Experiment
+    from instruments import load_instruments, candidate_instruments
+
+    exp = Experiment()
+    exp.days, exp.weeks, exp.months = days, weeks, months
+    exp.instrument, exp.instrument_type = instrument, instrument_type
+    candidate_instruments(load_instruments(), instrument, instrument_type)
+    return exp
+
+
+def show_suggestions(suggestions, top):
+    '''Lists the best few start dates found by score_start_dates()'''
+    if not suggestions:
+        click.echo('There are no days measurements can start on in that range.')
+        return
+
+    click.echo(f"{'start':<10} {'score':>8} {'moved':>6} {'days':>6}  instrument, experiments moved")
+    for suggestion in suggestions[:top]:
+        if suggestion.score is None:
+            click.echo(f"{suggestion.date.strftime('%d/%m/%y'):<10} {'does not fit':>22}  {suggestion.instrument}")
+            continue
+        click.echo(f"{suggestion.date.strftime('%d/%m/%y'):<10} {suggestion.score:>8} {suggestion.displaced:>6} "
+                   f"{suggestion.days_moved:>6}  {suggestion.instrument}"
+                   f"{': ' + ', '.join(suggestion.moved) if suggestion.moved else ''}")
+
+
+def add_experiments(calendar, experiments):
+    '''Adds experiments to the calendar and uploads it, unless they can't all fit in'''
+    from resolver import InfeasibleScheduleError
+    from storage import StaleScheduleError
+
+    try:
+        # bookings made directly in the Google calendars are kept clear of
+        calendar.refresh_events()
+        calendar.add_many(experiments)
+    except (InfeasibleScheduleError, StaleScheduleError) as e:
+        click.echo(f'\n{e}\nNothing has been changed.')
+        raise SystemExit(1)
+    calendar.Google_update()
+
+
+def experiment_row(experiment):
+    '''An experiment's details in the form read from an import file'''
+    return {'label': experiment.label, 'start_date': experiment.start_date.strftime('%d/%m/%y'),
+            'days': experiment.days, 'weeks': experiment.weeks, 'months': experiment.months,
+            'priority': experiment.priority, 'instrument': experiment.instrument,
+            'instrument_type': experiment.instrument_type}
+
+
+def read_experiment_file(path):
+    '''Reads experiment definitions from a CSV or JSON file as a list of dicts'''
+    with open(path, 'r', newline='') as file:
+        if path.lower().endswith('.json'):
+            return json.load(file)
+        return list(csv.DictReader(file))
+
+
+def build_experiments(rows):
+    '''
+    Creates an Experiment for each row, using its setters to validate the
+    values. Returns the experiments and a list of errors found in any row.
+    '''
+    from experiment import Experiment
+    from instruments import load_instruments, candidate_instruments
+
+    instruments = load_instruments()
+    experiments, errors = [], []
+    labels = set()
+    for number, row in enumerate(rows, 1):
+        exp = Experiment()
+        try:
+            if row.get('label') in labels:
+                raise ValueError('Experiment with this name appears more than once in the file!')
+            exp.label = require(row, 'label')
+            labels.add(exp.label)
+            exp.days = row.get('days') or 0
+            exp.weeks = row.get('weeks') or 0
+            exp.months = str(row.get('months') or '0').strip()
+            exp.priority = row.get('priority') or 1
+            exp.instrument = str(row.get('instrument') or '').strip() or None
+            exp.instrument_type = str(row.get('instrument_type') or '').strip() or None
+            candidate_instruments(instruments, exp.instrument, exp.instrument_type)
+            # setting the start date also works out the measurement days
+            exp.start_date = require(row, 'start_date')
+        except (ValueError, TypeError) as e:
+            errors.append(f"row {number} ({row.get('label', '?')}): {str(e).replace('ERROR: ', '').strip()}")
+        else:
+            experiments.append(exp)
+
+    return experiments, errors
+
+
+def require(row, column):
+    value = str(row.get(column) or '').strip()
+    if not value:
+        raise ValueError(f"missing value for '{column}'")
+    return value
+
+
 def program_selection():
     '''
     Prompts user to select how they would like to update the Solartron
     google calendar.
 
-    Inputs can only be 1 or 2.
+    Inputs can only be 1, 2 or 3.
 
     '''
-    return click.prompt('The options for updating the Solartron Google calendar are.. \n(1) Add experiment \n(2) Delete experiment\n\nSelect what option you would like to perform', type=click.Choice(['1', '2']))
+    return click.prompt('The options for updating the Solartron Google calendar are.. \n(1) Add experiment \n(2) Delete experiment\n(3) List experiments\n\nSelect what option you would like to perform', type=click.Choice(['1', '2', '3']))
+
+
+def list_experiments():
+    '''Lists the scheduled experiments in order of priority, highest first'''
+    from storage import ScheduleStore
+    from horizon import offset_date
+
+    entries = ScheduleStore().read_index()['experiments']
+    if not entries:
+        click.echo('No experiments are scheduled.')
+    for entry in entries:
+        first_test = '-' if entry.get('first') is None else offset_date(entry['first']).strftime('%d/%m/%y')
+        click.echo(f"• {entry['label']}: {entry['count']} measurements from {first_test}")
 
 
 def create_experiment():
@@ -55,7 +365,9 @@ def create_experiment():
       Defaults to the current date
 
     '''
-    exp = Experiment_test()
+    from experiment import Experiment
+
+    exp = Experiment()
 
     # Request unique name for the experiment
     while True:
@@ -89,6 +401,9 @@ def create_experiment():
             else:
                 break
 
+    # Request the instrument to use, if there's more than one to choose from
+    exp.instrument, exp.instrument_type = request_instrument()
+
     # Request start date for the experiment
     while True:
         try:
@@ -107,15 +422,16 @@ def create_experiment():
 def delete_experiment():
     '''Prompts user for the name of the experiment they would like to delete.'''
 
-    # Get experiment file names which can be deleted
-    experiment_files = [f for f in os.listdir('experiment_dates') if
-                        (os.path.isfile(os.path.join('experiment_dates', f)) and not f.startswith('.'))]
+    from storage import ScheduleStore
+
+    # Get experiment names which can be deleted
+    labels = ScheduleStore().labels()
 
-    experiment_string = ['• ' + name + '\n' for name in experiment_files]
+    experiment_string = ['• ' + name + '\n' for name in labels]
     experiment_string = ''.join(experiment_string)
-    # Prompt use to delete a file from this list
+    # Prompt use to delete an experiment from this list
     return click.prompt('Which experiment would you like to delete? \n' +
-                        experiment_string + '\n', type=click.Choice(experiment_files))
+                        experiment_string + '\n', type=click.Choice(labels))
 
 
 def request_name():
@@ -136,6 +452,25 @@ def request_schedule(single_test):
     return [days, weeks, months]
 
 
+def request_instrument():
+    '''
+    Prompt user for the instrument (or type of instrument) to book. Returns
+    an (instrument, instrument_type) pair, either of which may be None.
+    '''
+    from instruments import load_instruments
+
+    instruments = load_instruments()
+    if len(instruments) == 1:
+        return None, None
+
+    types = sorted({instrument.type for instrument in instruments.values()} - set(instruments))
+    choice = click.prompt('\nWhich instrument should the experiment use? Enter an instrument, a type of instrument, or "any"',
+                          type=click.Choice(list(instruments) + types + ['any']), default='any')
+    if choice in instruments:
+        return choice, None
+    return None, None if choice == 'any' else choice
+
+
 def request_start():
     '''Prompts user for the start date of the experiment being created'''
     clear_screen()
@@ -0,0 +1,171 @@
+import os
+import ast
+import sqlite3
+import datetime
+
+from horizon import day_offset
+
+# the state of each event: about to be inserted, confirmed to be in the
+# calendar, or about to be deleted. Events confirmed deleted are removed
+INSERTING = 'inserting'
+LIVE = 'live'
+DELETING = 'deleting'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    label TEXT NOT NULL,
+    calendar_id TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    recurrence TEXT
+);
+CREATE INDEX IF NOT EXISTS events_label ON events (label, day);
+CREATE TABLE IF NOT EXISTS versions (
+    label TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    created TEXT NOT NULL,
+    PRIMARY KEY (label, version)
+);
+CREATE TABLE IF NOT EXISTS history (
+    label TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    event_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_version ON history (label, version);
+'''
+
+
+class EventLedger:
+    '''
+    Journal of the Google calendar events written for each experiment.
+
+    Before anything is sent to the calendar each event is recorded as being
+    inserted or deleted, and it's marked live (or removed) once the calendar
+    has confirmed the write. If a sync is interrupted the events still
+    waiting are simply sent again by the next one - event IDs are derived
+    from the experiment and date, so sending a write twice is harmless.
+
+    After each sync the experiment's live events are saved as a new version
+    in the history tables, in place of the archived copy of the old lists.
+    '''
+
+    def __init__(self, path=os.path.join('schedule', 'ledger.sqlite3')):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        # the scheduler daemon uses the ledger from each request's thread in
+        # turn, never from two at once
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # the rollback journal keeps the database intact if the program dies
+        # mid-write. WAL mode doesn't work on network drives, which schedule/
+        # may be shared on, so ledgers made in WAL mode are switched back
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self.connection.executescript(SCHEMA)
+        # ledgers made before events could recur
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(events)')]
+        if 'recurrence' not in columns:
+            self.connection.execute('ALTER TABLE events ADD COLUMN recurrence TEXT')
+
+    def close(self):
+        self.connection.close()
+
+    def events(self, label):
+        '''(eventID, calendarId, day offset, state) of an experiment's events, by date'''
+        return self.connection.execute(
+            'SELECT event_id, calendar_id, day, state FROM events WHERE label = ? ORDER BY day',
+            (label,)).fetchall()
+
+    def event_ids(self, calendar_id):
+        '''IDs of every event recorded in a calendar'''
+        return {eventID for eventID, in self.connection.execute(
+            'SELECT event_id FROM events WHERE calendar_id = ?', (calendar_id,))}
+
+    def recurrences(self, label):
+        '''eventID -> recurrence (RRULE and EXDATE lines) of an experiment's recurring events'''
+        return dict(self.connection.execute(
+            'SELECT event_id, recurrence FROM events WHERE label = ? AND recurrence IS NOT NULL', (label,)))
+
+    def begin(self, label, calendar_id, inserts=(), deletes=(), recurrences=None):
+        '''
+        Records the (day, eventID) inserts and eventID deletes about to be
+        sent. recurrences gives the recurrence of any recurring events, by
+        eventID, and day is the first day of each.
+        '''
+        recurrences = recurrences or {}
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                [(eventID, label, calendar_id, int(day), INSERTING, recurrences.get(eventID))
+                 for day, eventID in inserts])
+            self.connection.executemany(
+                'UPDATE events SET state = ? WHERE event_id = ?',
+                [(DELETING, eventID) for eventID in deletes])
+
+    def confirm(self, method, event_id, commit=True):
+        '''Marks a write as done once the calendar has accepted it'''
+        if method == 'delete':
+            self.connection.execute('DELETE FROM events WHERE event_id = ?', (event_id,))
+        else:
+            self.connection.execute('UPDATE events SET state = ? WHERE event_id = ?', (LIVE, event_id))
+        if commit:
+            self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def save_version(self, label):
+        '''Saves the experiment's live events as its next version, returning the version number'''
+        with self.connection:
+            version, = self.connection.execute(
+                'SELECT COALESCE(MAX(version), 0) + 1 FROM versions WHERE label = ?', (label,)).fetchone()
+            self.connection.execute('INSERT INTO versions VALUES (?, ?, ?)',
+                                    (label, version, datetime.datetime.now().isoformat(timespec='seconds')))
+            self.connection.execute(
+                'INSERT INTO history SELECT label, ?, day, event_id FROM events WHERE label = ? AND state = ?',
+                (version, label, LIVE))
+        return version
+
+    def forget(self, label):
+        '''
+        Removes every trace of an experiment, apart from any events which
+        still have to be deleted from the calendar
+        '''
+        with self.connection:
+            self.connection.execute('DELETE FROM events WHERE label = ? AND state != ?', (label, DELETING))
+            for table in ('versions', 'history'):
+                self.connection.execute(f'DELETE FROM {table} WHERE label = ?', (label,))
+
+    def deleting(self):
+        '''(label, eventID, calendarId) of every event waiting to be deleted'''
+        return self.connection.execute(
+            'SELECT label, event_id, calendar_id FROM events WHERE state = ?', (DELETING,)).fetchall()
+
+    def migrate(self, directory, calendar_of):
+        '''
+        One-shot import of the experiment_dates text files, each a list of
+        (dd/mm/yy date, eventID), as live events. Archived lists become the
+        first version of each experiment's history and the current lists the
+        second. calendar_of gives the calendar ID for an experiment. The old
+        directory is kept as experiment_dates.bak.
+        '''
+        def read(path):
+            with open(path, 'r') as file:
+                return [(day_offset(datetime.datetime.strptime(date, '%d/%m/%y')), eventID)
+                        for date, eventID in ast.literal_eval(file.read())]
+
+        labels = [name for name in os.listdir(directory)
+                  if os.path.isfile(os.path.join(directory, name)) and not name.startswith('.')]
+        for label in labels:
+            archive = os.path.join(directory, 'archive', label)
+            if os.path.exists(archive):
+                self.begin(label, calendar_of(label), read(archive))
+                self.connection.execute('UPDATE events SET state = ? WHERE label = ?', (LIVE, label))
+                self.save_version(label)
+                self.connection.execute('DELETE FROM events WHERE label = ?', (label,))
+
+            self.begin(label, calendar_of(label), read(os.path.join(directory, label)))
+            self.connection.execute('UPDATE events SET state = ? WHERE label = ?', (LIVE, label))
+            self.save_version(label)
+
+        os.replace(directory, directory.rstrip('/') + '.bak')
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+
+# time spent in each phase of a run, in seconds, and counts of the work done
+# (solver iterations, API calls, bytes written...). Both are kept for the
+# whole process, so anything can record into them without passing them around
+timings = OrderedDict()
+counts = Counter()
+_lock = threading.Lock()
+_stack = threading.local()
+
+
+@contextmanager
+def timer(phase):
+    '''
+    Adds the time spent in the block to a phase. A phase timed inside
+    another one is recorded as "outer/inner".
+    '''
+    stack = getattr(_stack, 'phases', None)
+    if stack is None:
+        stack = _stack.phases = []
+    name = '/'.join(stack + [phase])
+    stack.append(phase)
+    with _lock:
+        # listed in the order phases start, so outer phases come first
+        timings.setdefault(name, 0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        with _lock:
+            timings[name] = timings.get(name, 0) + elapsed
+
+
+def count(name, amount=1):
+    with _lock:
+        counts[name] += amount
+
+
+def merge(metrics):
+    '''Adds the timings and counts from another process's snapshot()'''
+    with _lock:
+        for phase, seconds in metrics.get('timings', {}).items():
+            timings[phase] = timings.get(phase, 0) + seconds
+        counts.update(metrics.get('counts', {}))
+
+
+def reset():
+    with _lock:
+        timings.clear()
+        counts.clear()
+
+
+def snapshot():
+    '''The metrics recorded so far, as a JSON-friendly dict'''
+    with _lock:
+        return {'timings': OrderedDict(timings), 'counts': dict(sorted(counts.items()))}
+
+
+def report():
+    '''Text breakdown of the time spent in each phase and the counters'''
+    metrics = snapshot()
+    lines = ['Phase breakdown (ms):']
+    for phase, seconds in metrics['timings'].items():
+        depth = phase.count('/')
+        lines.append(f"{'  ' * depth}{phase.split('/')[-1]:<{32 - 2 * depth}} {seconds * 1000:10.1f}")
+    if metrics['counts']:
+        lines.append('\nCounts:')
+        lines.extend(f'{name:<32} {value:10}' for name, value in metrics['counts'].items())
+    return '\n'.join(lines)
+
+
+def append_metrics(path, **details):
+    '''Appends this run's metrics to a file as one line of JSON'''
+    record = OrderedDict(time=datetime.datetime.now().isoformat(timespec='seconds'))
+    record.update(details)
+    record.update(snapshot())
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a') as file:
+        file.write(json.dumps(record) + '\n')
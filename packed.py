@@ -0,0 +1,162 @@
+import numpy as np
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:  # numpy < 2.0
+    _BITS = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+    def popcount(array):
+        return _BITS[array]
+
+
+class PackedSchedule:
+    '''
+    The active schedule, with each experiment's tests held as a bitset of
+    one bit per day, and the experiments' priority order kept as a separate
+    list of labels (highest first).
+
+    Adding an experiment at the top only inserts its label into the list, so
+    none of the other experiments' data is copied. An experiment with more
+    than one test on a day has an extra bit plane for each extra test.
+
+    The number of tests on each day, and the days with more tests than an
+    instrument can take, are worked out with bitwise operations on whole
+    bytes of days at a time.
+    '''
+
+    def __init__(self, start, length):
+        self.start = start
+        self.length = length
+        self.labels = []
+        self._bits = {}  # label -> (planes x bytes) array of packed days
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+    @property
+    def index(self):
+        return range(self.start, self.end)
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, label):
+        return label in self._bits
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __getitem__(self, label):
+        '''Number of tests on each day of the window'''
+        planes = np.unpackbits(self._bits[label], axis=1, count=self.length, bitorder='little')
+        return planes.sum(axis=0).astype(float)
+
+    def __setitem__(self, label, tests):
+        '''Replaces an experiment's tests, adding it at the lowest priority if it's new'''
+        if label not in self._bits:
+            self.labels.append(label)
+        self._bits[label] = self.pack(tests)
+
+    def insert(self, position, label, tests):
+        if label in self._bits:
+            raise ValueError(f'cannot insert {label}, already exists')
+        self.labels.insert(position, label)
+        self._bits[label] = self.pack(tests)
+
+    def remove(self, label):
+        self.labels.remove(label)
+        del self._bits[label]
+
+    def pack(self, tests):
+        tests = np.asarray(tests)
+        planes = max(int(tests.max(initial=0)), 1)
+        return np.packbits(tests[None, :] > np.arange(planes)[:, None], axis=1, bitorder='little')
+
+    def offsets(self, label):
+        '''Sorted absolute day offsets of an experiment's tests, repeated for days with several'''
+        tests = self[label].astype(np.int64)
+        return np.repeat(np.arange(self.start, self.end, dtype=np.int32), tests)
+
+    def items(self):
+        '''
+        (label, sorted absolute day offsets) for every experiment in order of
+        priority, found in one pass over the whole schedule
+        '''
+        if not self.labels:
+            return
+        planes = [len(self._bits[label]) for label in self.labels]
+        plane, day = np.nonzero(np.unpackbits(self.stacked(self.labels), axis=1, count=self.length,
+                                              bitorder='little'))
+        # the experiment each test belongs to, with an experiment's extra
+        # tests (on later planes) sorted in among its others
+        row = np.repeat(np.arange(len(self.labels)), planes)[plane]
+        if max(planes) > 1:
+            order = np.lexsort((day, row))
+            row, day = row[order], day[order]
+        offsets = np.split((day + self.start).astype(np.int32),
+                           np.searchsorted(row, np.arange(1, len(self.labels))))
+        yield from zip(self.labels, offsets)
+
+    def count(self, label):
+        return int(popcount(self._bits[label]).sum())
+
+    def extend(self, end):
+        '''Lengthens the window to finish at day offset end'''
+        if end <= self.end:
+            return
+        self.length = end - self.start
+        size = (self.length + 7) // 8
+        for label, bits in self._bits.items():
+            self._bits[label] = np.pad(bits, ((0, 0), (0, size - bits.shape[1])))
+
+    def stacked(self, labels):
+        '''Every bit plane of the experiments given, as one (planes x bytes) array'''
+        size = (self.length + 7) // 8
+        if not labels:
+            return np.zeros((0, size), dtype=np.uint8)
+        return np.concatenate([self._bits[label] for label in labels])
+
+    def occupancy(self, labels):
+        '''Number of tests on each day of the window, over the experiments given'''
+        return np.unpackbits(self.stacked(labels), axis=1, count=self.length,
+                             bitorder='little').sum(axis=0).astype(float)
+
+    def at_least(self, labels, count):
+        '''
+        Packed mask of the days with at least `count` tests. A day has at
+        least k tests by row i if it had at least k by the row before, or it
+        had k - 1 by then and row i has one, so each level is an OR
+        accumulated over the rows ANDed with the level below.
+        '''
+        rows = self.stacked(labels)
+        size = rows.shape[1]
+        if count <= 0:
+            return np.full(size, 0xff, dtype=np.uint8)
+        if len(rows) < count:
+            return np.zeros(size, dtype=np.uint8)
+
+        level = np.bitwise_or.accumulate(rows, axis=0)
+        for _ in range(count - 1):
+            level = np.concatenate((np.zeros((1, size), dtype=np.uint8),
+                                    np.bitwise_or.accumulate(rows[1:] & level[:-1], axis=0)))
+        return level[-1]
+
+    def over_capacity(self, labels, capacity):
+        '''
+        Packed mask of the days with more tests than their capacity (a vector
+        with a whole number of tests for each day of the window)
+        '''
+        capacity = np.clip(np.asarray(capacity, dtype=int), 0, None)
+        over = np.zeros((self.length + 7) // 8, dtype=np.uint8)
+        for level in np.unique(capacity):
+            days = np.packbits(capacity == level, bitorder='little')
+            over |= self.at_least(labels, level + 1) & days
+        return over
+
+    def collision_days(self, labels, capacity):
+        '''Number of days with more tests than their capacity'''
+        return int(popcount(self.over_capacity(labels, capacity)).sum())
+
+    def total(self):
+        return sum(self.count(label) for label in self.labels)
@@ -0,0 +1,183 @@
+import datetime
+from functools import lru_cache
+
+import numpy as np
+
+from horizon import EPOCH, day_offset, weekend_mask
+
+MONTH = 28  # months are treated as 4 weeks
+
+
+def easter_sunday(year):
+    '''Date of Easter Sunday (anonymous Gregorian algorithm)'''
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def _monday_on_or_after(date):
+    return date + datetime.timedelta(days=-date.weekday() % 7)
+
+
+def _weekday_on_or_after(date):
+    return _monday_on_or_after(date) if date.weekday() > 4 else date
+
+
+def _last_monday(year, month):
+    last_day = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last_day - datetime.timedelta(days=last_day.weekday())
+
+
+# bank holidays which were moved or added by proclamation
+_ENGLAND_AND_WALES_MOVED = {
+    (2020, 'early may'): datetime.date(2020, 5, 8),
+    (2002, 'spring'): datetime.date(2002, 6, 4),
+    (2012, 'spring'): datetime.date(2012, 6, 4),
+    (2022, 'spring'): datetime.date(2022, 6, 2),
+}
+_ENGLAND_AND_WALES_EXTRA = [
+    datetime.date(2002, 6, 3), datetime.date(2011, 4, 29), datetime.date(2012, 6, 5),
+    datetime.date(2022, 6, 3), datetime.date(2022, 9, 19), datetime.date(2023, 5, 8),
+]
+
+
+def england_and_wales_bank_holidays(year):
+    '''Bank holidays in England and Wales, with weekend substitute days'''
+    easter = easter_sunday(year)
+    holidays = {
+        'new year': _weekday_on_or_after(datetime.date(year, 1, 1)),
+        'good friday': easter - datetime.timedelta(days=2),
+        'easter monday': easter + datetime.timedelta(days=1),
+        'early may': _monday_on_or_after(datetime.date(year, 5, 1)),
+        'spring': _last_monday(year, 5),
+        'summer': _last_monday(year, 8),
+    }
+    for (moved_year, name), date in _ENGLAND_AND_WALES_MOVED.items():
+        if moved_year == year:
+            holidays[name] = date
+
+    # if christmas or boxing day is at the weekend, the following weekdays are taken instead
+    christmas = [datetime.date(year, 12, 25), datetime.date(year, 12, 26)]
+    substitute = datetime.date(year, 12, 27)
+    for day in christmas:
+        if day.weekday() > 4:
+            while substitute.weekday() > 4:
+                substitute += datetime.timedelta(days=1)
+            christmas.append(substitute)
+            substitute += datetime.timedelta(days=1)
+
+    return sorted(list(holidays.values()) + christmas +
+                  [date for date in _ENGLAND_AND_WALES_EXTRA if date.year == year])
+
+
+# functions listing the holidays in a year - register new sets of holidays here
+HOLIDAY_SETS = {
+    'england-and-wales': england_and_wales_bank_holidays,
+}
+# the holidays no measurements are scheduled on
+HOLIDAYS = ('england-and-wales',)
+
+
+@lru_cache(maxsize=None)
+def year_mask(year, holidays=HOLIDAYS):
+    '''Cached, read-only mask of the weekends and holidays in a year'''
+    first = day_offset(datetime.date(year, 1, 1))
+    offsets = np.arange(first, day_offset(datetime.date(year + 1, 1, 1)))
+    mask = weekend_mask(offsets)
+    for name in holidays:
+        days = [day_offset(date) - first for date in HOLIDAY_SETS[name](year)]
+        mask[days] = True
+    mask.flags.writeable = False
+    return mask
+
+
+def blackout_mask(first, last, holidays=HOLIDAYS, closed_days=()):
+    '''
+    True for each day offset in [first, last) that no measurement can be
+    booked on: weekends, holidays and any closed_days (e.g. when an
+    instrument is being maintained).
+    '''
+    first_year = (EPOCH + datetime.timedelta(days=int(first))).year
+    last_year = (EPOCH + datetime.timedelta(days=int(max(last, first + 1)) - 1)).year
+    year_start = day_offset(datetime.date(first_year, 1, 1))
+
+    mask = np.concatenate([year_mask(year, tuple(holidays))
+                           for year in range(first_year, last_year + 1)])
+    mask = mask[first - year_start:last - year_start]
+
+    closed_days = np.asarray(closed_days, dtype=int)
+    closed_days = closed_days[(closed_days >= first) & (closed_days < last)]
+    if len(closed_days):
+        mask = mask.copy()
+        mask[closed_days - first] = True
+    return mask
+
+
+def _ranges(starts, counts, step=1):
+    '''
+    For groups i with counts[i] members, returns (group, value) arrays where
+    the values run starts[i], starts[i] + step, ... for each group
+    '''
+    counts = np.asarray(counts, dtype=int)
+    groups = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return groups, np.repeat(np.asarray(starts, dtype=int), counts) + step * position
+
+
+def compile_schedules(starts, days, weeks, months, holidays=HOLIDAYS, closed_days=()):
+    '''
+    Works out the measurement days of many experiments in one pass.
+
+    Each experiment starts with a test on its start day, then has daily tests
+    for `days` days (skipping blocked days), then `weeks` weekly tests and
+    finally `months` tests every 28 days. Weekly tests follow on from the last
+    daily test, unless that was a friday when they start a week after the
+    start day. All arguments are sequences with one value per experiment,
+    starts being day offsets, and a list of arrays of absolute day offsets is
+    returned.
+    '''
+    starts = np.asarray(starts, dtype=int)
+    days, weeks, months = (np.asarray(values, dtype=int) for values in (days, weeks, months))
+    count = len(starts)
+    if not count:
+        return []
+
+    # the first test, then the daily tests which aren't on blocked days
+    groups, daily = _ranges(np.zeros(count), days)
+    first = starts.min()
+    blocked = blackout_mask(first, int((starts + np.maximum(days, 1)).max()), holidays, closed_days)
+    keep = ~blocked[starts[groups] + daily - first]
+    groups = np.concatenate((np.arange(count), groups[keep]))
+    tests = np.concatenate((np.zeros(count, dtype=int), daily[keep]))
+
+    last_test = np.zeros(count, dtype=int)
+    np.maximum.at(last_test, groups, tests)
+
+    # weekly tests, which start a week after the start day if the daily tests ended on a friday
+    weekly = weeks > 0
+    anchor = np.where((starts + last_test) % 7 == 4, 7, last_test)
+    weekly_groups, weekly_tests = _ranges(anchor[weekly], weeks[weekly] + 1, 7)
+    weekly_groups = np.flatnonzero(weekly)[weekly_groups]
+    last_test = np.where(weekly, np.maximum(last_test, anchor + 7 * weeks), last_test)
+
+    # monthly tests carry on from the last test so far
+    monthly_groups, monthly_tests = _ranges(last_test, months + 1, MONTH)
+
+    groups = np.concatenate((groups, weekly_groups, monthly_groups))
+    offsets = starts[groups] + np.concatenate((tests, weekly_tests, monthly_tests))
+
+    # sort by experiment then day, dropping days listed twice
+    order = np.lexsort((offsets, groups))
+    groups, offsets = groups[order], offsets[order]
+    unique = np.ones(len(offsets), dtype=bool)
+    unique[1:] = (groups[1:] != groups[:-1]) | (offsets[1:] != offsets[:-1])
+    groups, offsets = groups[unique], offsets[unique]
+
+    return np.split(offsets, np.cumsum(np.bincount(groups, minlength=count))[:-1])
@@ -0,0 +1,392 @@
+import time
+import heapq
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+import numpy as np
+
+import metrics
+
+
+class InfeasibleScheduleError(Exception):
+    '''
+    Raised when tests can't all be fitted into the schedule. units lists the
+    (day, column) of the tests which couldn't be placed, where known.
+    '''
+
+    def __init__(self, message, units=()):
+        super().__init__(message)
+        self.units = list(units)
+
+
+class Solver:
+    '''
+    Interface for collision solvers.
+
+    solve() takes a (days x columns) array of tests per day, whose first
+    column marks days which are blocked out (weekends etc.) and whose other
+    columns are experiments in order of priority, highest first, along with
+    the number of tests which fit on each day. It moves tests so that no day
+    is over capacity, modifying the array in place and returning it, and
+    raises InfeasibleScheduleError if that can't be done.
+    '''
+
+    def solve(self, schedule, capacity=None):
+        raise NotImplementedError
+
+
+class HeuristicSolver(Solver):
+    '''Nudges the lowest priority test on each collision day towards the nearest free day'''
+
+    def solve(self, schedule, capacity=None):
+        resolver = CollisionResolver(schedule, capacity)
+        try:
+            return resolver.resolve()
+        finally:
+            metrics.count('solver iterations', resolver.passes)
+
+
+class CollisionResolver:
+    '''
+    Moves lower priority tests out of the way until no day in the schedule
+    has more tests on it than the instrument can measure, by default one.
+
+    Gives exactly the same schedule as nudging the oldest test on each
+    collision day one day towards the nearest free day and then summing the
+    whole calendar again. Instead of re-summing after every move, the number
+    of tests on each day, a sorted index of the free days and the set of
+    collision days are updated in place, so a move only touches the two days
+    involved and an add scales with the number of displaced tests.
+
+    Where some days fit more than one test, an experiment could also end up
+    with two tests on one day without it being over capacity (they'd be the
+    same calendar event). Such days count as collisions too, and tests are
+    only moved towards, and nudged past, days their experiment doesn't
+    already have a test on.
+    '''
+
+    def __init__(self, schedule, capacity=None, max_passes=1000000000):
+        # schedule is modified in place - rows are days, columns are
+        # experiments in order of priority (highest first)
+        self.schedule = schedule
+        self.max_passes = max_passes
+        self.passes = 0
+        self.moves = 0
+
+        # the number of tests which fit on each day, one unless given
+        if capacity is None:
+            capacity = np.ones(len(schedule))
+        self.capacity = np.asarray(capacity)
+
+        self.daily_test_count = np.sum(schedule, axis=1)
+        # with one test a day an experiment's second test puts the day over
+        # capacity, so only larger capacities need its tests counting
+        self.doubles = bool(np.any(self.capacity > 1))
+        # tests on each day beyond an experiment's first
+        self.extra_tests = np.zeros(len(schedule))
+        if self.doubles:
+            self.extra_tests = np.sum(np.clip(schedule[:, 1:] - 1, 0, None), axis=1)
+        self.free_days = np.where((self.daily_test_count >= 0) &
+                                  (self.daily_test_count < self.capacity))[0].tolist()
+        self.collisions = set(np.where((self.daily_test_count > self.capacity) | (self.extra_tests > 0))[0].tolist())
+
+    def resolve(self):
+        # recalculate and move test schedules while there are days with
+        # collisions in the test calendar
+        while self.collisions:
+            # break out of program if caught in endless loop / taking too long
+            self.passes += 1
+            if self.passes > self.max_passes:
+                raise InfeasibleScheduleError('Cannot find optimal solution to scheduling calendar. Too many experiments currently listed')
+
+            # iterate through the days collisions were detected on at the
+            # start of this pass, in date order
+            for day in sorted(self.collisions):
+                self.move_test(day)
+
+        return self.schedule
+
+    def move_test(self, day):
+        tests = self.schedule[day, :]
+        # get oldest test in collision, or the experiment with two tests
+        oldest_test = np.flatnonzero(tests == tests.max())[-1]
+
+        free_day = self.nearest_free_day(day, oldest_test)
+        if free_day is None:
+            raise InfeasibleScheduleError('There are no free days left in the existing timeframe :(\nPlease delete or downsample the frequency of lower priority experiments.',
+                                          [(day, oldest_test)])
+
+        # determine which direction the nearest free day is (past or future),
+        # and step over any days the experiment already has a test on
+        step = int(np.sign(free_day - day))
+        if step == 0:
+            return
+
+        new_date = day + step
+        while self.doubles and self.schedule[new_date, oldest_test] > 0:
+            new_date += step
+        self.schedule[new_date, oldest_test] += 1
+        self.schedule[day, oldest_test] -= 1
+        self.update_count(new_date, 1, oldest_test)
+        self.update_count(day, -1, oldest_test)
+        self.moves += 1
+
+    def nearest_free_day(self, day, column):
+        '''
+        The nearest free day (without a test of the column's experiment on
+        it, where days fit more than one test), or None if there isn't one.
+        When two are equally close the earlier one wins.
+        '''
+        def taken(i):
+            return self.doubles and self.schedule[self.free_days[i], column] > 0
+
+        i = bisect_left(self.free_days, day)
+        after = i
+        while after < len(self.free_days) and taken(after):
+            after += 1
+        before = i - 1
+        while before >= 0 and taken(before):
+            before -= 1
+
+        if after == len(self.free_days):
+            return self.free_days[before] if before >= 0 else None
+        if before < 0:
+            return self.free_days[after]
+        before, after = self.free_days[before], self.free_days[after]
+        return before if day - before <= after - day else after
+
+    def update_count(self, day, change, column):
+        old_count = self.daily_test_count[day]
+        new_count = old_count + change
+        self.daily_test_count[day] = new_count
+        if self.doubles:
+            tests = self.schedule[day, column]  # already changed
+            self.extra_tests[day] += max(tests - 1, 0) - max(tests - change - 1, 0)
+
+        capacity = self.capacity[day]
+        was_free = 0 <= old_count < capacity
+        is_free = 0 <= new_count < capacity
+        if was_free and not is_free:
+            del self.free_days[bisect_left(self.free_days, day)]
+        if is_free and not was_free:
+            insort(self.free_days, day)
+
+        if new_count > capacity or self.extra_tests[day] > 0:
+            self.collisions.add(day)
+        else:
+            self.collisions.discard(day)
+
+
+class AssignmentSolver(Solver):
+    '''
+    Places tests by solving a minimum cost assignment.
+
+    On each day over capacity the highest priority tests stay put and the
+    rest are displaced. Each displaced test is then assigned to a free
+    weekday at most max_drift days from where it was, at a cost of the
+    distance moved weighted by the experiment's priority, so that the total
+    cost over all displaced tests is as low as possible.
+
+    Like the tests which stay put, no two displaced tests of an experiment
+    are placed on the same day. A greedy placement (highest priority first,
+    each to its cheapest free day) is found first, then improved to the
+    optimal assignment by successive shortest augmenting paths. If
+    time_budget seconds run out before that finishes the greedy placement
+    is used, timed_out is set and a solver timeout is counted.
+    '''
+
+    def __init__(self, time_budget=5.0, max_drift=28, clock=time.monotonic):
+        self.time_budget = time_budget
+        self.max_drift = max_drift
+        self.clock = clock
+        self.timed_out = False
+        self.cost = 0
+
+    def solve(self, schedule, capacity=None):
+        deadline = self.clock() + self.time_budget
+        self.timed_out = False
+        if capacity is None:
+            capacity = np.ones(len(schedule))
+        capacity = np.asarray(capacity)
+
+        units = self.displace(schedule, capacity)
+        if not units:
+            self.cost = 0
+            return schedule
+
+        # the number of extra tests each day has room for - blocked days are
+        # full as they're marked in the first column
+        counts = np.sum(schedule, axis=1)
+        free = np.where(counts >= 0, np.clip(capacity - counts, 0, None), 0).astype(int)
+        candidates = self.candidates(schedule, units, free)
+
+        greedy, unplaced = self.greedy(units, candidates, free)
+        assignment = self.optimise(units, candidates, free, deadline)
+        if assignment is None:
+            # out of time, so the greedy placement is used if it's complete
+            metrics.count('solver timeouts')
+            if unplaced:
+                raise InfeasibleScheduleError(
+                    f'Could not place {len(unplaced)} tests within {self.max_drift} days of their '
+                    f'original dates in the time available.', unplaced)
+            assignment = greedy
+
+        self.cost = sum(candidates[unit][day] for unit, day in assignment.items())
+        for unit, day in assignment.items():
+            schedule[day, units[unit][1]] += 1
+        return schedule
+
+    def displace(self, schedule, capacity):
+        '''
+        Takes the lowest priority tests off every day over capacity, returning
+        them as a list of (day, column)
+        '''
+        units = []
+        counts = np.sum(schedule, axis=1)
+        for day in np.flatnonzero(counts > capacity):
+            room = capacity[day]
+            for column in np.flatnonzero(schedule[day] > 0):
+                keep = min(schedule[day, column], room)
+                room -= keep
+                units.extend([(int(day), int(column))] * int(schedule[day, column] - keep))
+                schedule[day, column] = keep
+        return units
+
+    def candidates(self, schedule, units, free):
+        '''
+        For each displaced test, a dict of the days it may move to -> cost.
+        Higher priority experiments (lower columns) cost more to move, and
+        a test can't go on a day its experiment already has a test on.
+        '''
+        columns = schedule.shape[1]
+        candidates = []
+        for day, column in units:
+            first, last = max(day - self.max_drift, 0), min(day + self.max_drift + 1, len(schedule))
+            days = np.arange(first, last)
+            allowed = days[(free[first:last] > 0) & (schedule[first:last, column] == 0)]
+            weight = columns - column
+            candidates.append({int(new_day): int(weight * abs(new_day - day)) for new_day in allowed})
+        return candidates
+
+    def greedy(self, units, candidates, free):
+        remaining = free.copy()
+        taken = set()  # (day, column) pairs given to a displaced test
+        assignment, unplaced = {}, []
+        # highest priority first, then in date order
+        for unit in sorted(range(len(units)), key=lambda unit: (units[unit][1], units[unit][0])):
+            column = units[unit][1]
+            options = sorted((cost, day) for day, cost in candidates[unit].items()
+                             if remaining[day] > 0 and (day, column) not in taken)
+            if not options:
+                unplaced.append(units[unit])
+                continue
+            day = options[0][1]
+            assignment[unit] = day
+            remaining[day] -= 1
+            taken.add((day, column))
+        return assignment, unplaced
+
+    def optimise(self, units, candidates, free, deadline):
+        '''
+        Minimum cost assignment by successive shortest augmenting paths
+        (Dijkstra with node potentials). Returns None if the deadline passes,
+        and raises InfeasibleScheduleError if some tests can't be placed.
+
+        Each test reaches a day through a slot for its experiment on that
+        day, which holds one test, so no experiment gets two tests on the
+        same day.
+        '''
+        remaining = {day: int(free[day]) for options in candidates for day in options}
+        assignment = {}  # unit -> day
+        occupant = {}  # (column, day) slot -> unit assigned to it
+        on_day = defaultdict(set)  # day -> columns with a unit assigned to it
+        # node potentials keeping the reduced costs non-negative. Only their
+        # differences matter, so rather than raising every node not reached
+        # by a search, the nodes reached are lowered instead
+        potential = defaultdict(int)
+        unplaced = []
+
+        for source in range(len(units)):
+            if self.clock() > deadline:
+                self.timed_out = True
+                return None
+
+            metrics.count('solver iterations')
+            start = ('unit', source)
+            dist, previous, done = {start: 0}, {}, {}
+            heap = [(0, start)]
+            target = None
+            while heap:
+                d, node = heapq.heappop(heap)
+                if node in done:
+                    continue
+                done[node] = d
+                kind, key = node
+                if kind == 'day':
+                    if remaining[key] > 0:
+                        target = node
+                        break
+                    # take one of the tests on this day out of its slot
+                    edges = [(('slot', (column, key)), 0) for column in on_day[key]]
+                elif kind == 'slot':
+                    column, day = key
+                    unit = occupant.get(key)
+                    # an empty slot leads to its day, and a full one to moving
+                    # its test somewhere else
+                    edges = ([(('day', day), 0)] if unit is None else
+                             [(('unit', unit), -candidates[unit][day])])
+                else:
+                    column = units[key][1]
+                    edges = [(('slot', (column, day)), cost) for day, cost in candidates[key].items()
+                             if assignment.get(key) != day]
+                for next_node, cost in edges:
+                    reduced = cost + potential[node] - potential[next_node]
+                    if d + reduced < dist.get(next_node, float('inf')):
+                        dist[next_node] = d + reduced
+                        previous[next_node] = node
+                        heapq.heappush(heap, (d + reduced, next_node))
+
+            if target is None:
+                unplaced.append(units[source])
+                continue
+
+            # keep reduced costs non-negative for the next search
+            total = done[target]
+            for node, d in done.items():
+                potential[node] += d - total
+
+            # each test on the path moves to the slot after it
+            path = [target]
+            while path[-1] != start:
+                path.append(previous[path[-1]])
+            path.reverse()
+            remaining[target[1]] -= 1
+            for node, next_node in zip(path, path[1:]):
+                if node[0] != 'unit' or next_node[0] != 'slot':
+                    continue
+                unit, (column, day) = node[1], next_node[1]
+                old_day = assignment.get(unit)
+                if old_day is not None and occupant.get((column, old_day)) == unit:
+                    del occupant[(column, old_day)]
+                    on_day[old_day].discard(column)
+                assignment[unit] = day
+                occupant[(column, day)] = unit
+                on_day[day].add(column)
+
+        if unplaced:
+            raise InfeasibleScheduleError(
+                f'The schedule is infeasible: {len(unplaced)} tests cannot be placed within '
+                f'{self.max_drift} days of their original dates.', unplaced)
+        return assignment
+
+
+SOLVERS = {
+    'heuristic': HeuristicSolver,
+    'assignment': AssignmentSolver,
+}
+
+
+def get_solver(name='heuristic', **options):
+    if name not in SOLVERS:
+        raise ValueError(f"\nERROR: Unknown solver '{name}'. Choose from {', '.join(SOLVERS)}.")
+    return SOLVERS[name](**options)
@@ -1,246 +1,440 @@
-import ast
 import sys
-import json
+import itertools
 import datetime
-import progressbar
 import numpy as np
-import pandas as pd
-from random import choice
-from shutil import copyfile
 from collections import OrderedDict
 
-import httplib2
 import os
 
-from apiclient import discovery
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
-
-SCOPES = 'https://www.googleapis.com/auth/calendar'
-CLIENT_SECRET_FILE = 'client_secret.json'
-APPLICATION_NAME = 'Google Calendar API Python Quickstart'
+import metrics
+from backends import get_backend
+from batch import status_of
+from event_cache import EventCache
+from ledger import EventLedger, INSERTING, LIVE, DELETING
+from resolver import InfeasibleScheduleError, get_solver
+from instruments import load_instruments, candidate_instruments, least_loaded
+from horizon import day_offset, iso_dates, window_days, extend_repeat
+from recurrence import blackout_mask
+from storage import ScheduleStore, StaleScheduleError, day_vector
+from packed import PackedSchedule
+from sync import START_TIME, END_TIME, TIME_ZONE, plan_sync
+
+# progressbar and the Google API client libraries are slow to import,
+# so they are only imported by the methods which need them
+
+# times experiments are added to a freshly loaded schedule when someone else
+# keeps saving it first
+SAVE_ATTEMPTS = 5
+# writes confirmed in the ledger between commits - if an upload is
+# interrupted, writes which weren't committed are simply sent again
+CONFIRM_EVERY = 50
 
 
 class Calendar:
 
-    def __init__(self):
-        """Gets valid user credentials from storage.
+    def __init__(self, solver='heuristic', backend='google', **solver_options):
+        """
+        Nothing is loaded up front: the saved schedule is read the first time
+        it's used, and the Google calendar service is only authorised when an
+        update actually needs to be sent.
+
+        solver names the collision solver to use (see resolver.SOLVERS), and
+        any other keyword arguments are passed on to it. backend is where the
+        events are kept, either a name from backends.BACKENDS or a
+        CalendarBackend.
+        """
+        self.solver = get_solver(solver, **solver_options)
+        self.backend = get_backend(backend) if isinstance(backend, str) else backend
+        self.store = ScheduleStore()
+        self.instruments = load_instruments()
+        # the instrument each experiment is booked on
+        self.assignments = self.store.attribute('instrument')
+        # what's in the Google calendars, including bookings made directly in them
+        self.events = EventCache()
+        self._calendar = None
+        self._ledger = None
+        self.unconfirmed = 0
+        self.bar = None
+
+    @property
+    def calendar(self):
+        if self._calendar is None:
+            # load existing calendar file with previous test dates
+            self.initialise_schedule()
+        return self._calendar
+
+    @calendar.setter
+    def calendar(self, calendar):
+        self._calendar = calendar
+
+    def reload(self):
+        """
+        Forgets the loaded schedule, instruments and assignments, so they're
+        read again the next time they're used (e.g. after another process has
+        changed them). The backend, e.g. the Google service, is kept.
+        """
+        self.instruments = load_instruments()
+        self.assignments = self.store.attribute('instrument')
+        self.events = EventCache()
+        self._calendar = None
 
-        If nothing has been stored, or if the stored credentials are invalid,
-        the OAuth2 flow is completed to obtain the new credentials.
+    @property
+    def experiment_labels(self):
+        return self.store.labels()
 
+    @metrics.timer('refresh events')
+    def refresh_events(self):
         """
-        home_dir = os.path.expanduser('~')
-        credential_dir = os.path.join(home_dir, '.credentials')
-        if not os.path.exists(credential_dir):
-            os.makedirs(credential_dir)
-        credential_path = os.path.join(credential_dir,
-                                       'calendar-python-quickstart.json')
-
-        store = Storage(credential_path)
-        self.credentials = store.get()
-        if not self.credentials or self.credentials.invalid:
-            flow = client.flow_from_clientsecrets(CLIENT_SECRET_FILE, SCOPES)
-            flow.user_agent = APPLICATION_NAME
-            if flags:
-                self.credentials = tools.run_flow(flow, store, flags)
-            else:  # Needed only for compatibility with Python 2.6
-                self.credentials = tools.run(flow, store)
-            print('Storing credentials to ' + credential_path)
-
-        self.http = self.credentials.authorize(httplib2.Http())
-        self.service = discovery.build('calendar', 'v3', http=self.http)
-
-        # load existing calendar file with previous test dates
-        self.initialise_schedule()
-
-    def initialise_schedule(self):
-        """Load existing calendar file with previous test dates"""
-        if os.path.exists('data.json'):
-            with open('data.json', 'r') as file:
-                # Use OrderedDict to keep the priority of the experiments added.
-                data = json.load(file, object_pairs_hook=OrderedDict)
-                self.calendar = pd.DataFrame.from_dict(data)
-                # Get int type of index - which are imported as strings and unordered
-                new_index = [int(x) for x in self.calendar.index]
-                self.calendar.set_index(keys=[new_index], inplace=True)
-                self.calendar.sort_index(inplace=True)
-        # If calendar does not exist, create it
-        else:
-            self.calendar = pd.DataFrame(index=range(365))
+        Updates the local copy of each instrument's Google calendar, so
+        bookings other people have made directly in it are kept clear of.
+        Events in the ledger are this program's, even without the marker
+        (e.g. those written before it was added).
+        """
+        for calendar_id in dict.fromkeys(instrument.calendar_id for instrument in self.instruments.values()):
+            self.events.refresh(self.backend, calendar_id, self.ledger.event_ids(calendar_id))
 
-        self.experiment_labels = self.calendar.columns
+    @metrics.timer('load schedule')
+    def initialise_schedule(self, today=None, read_only=False):
+        """
+        Load existing calendar file with previous test dates. With read_only
+        nothing on disk is changed, so old schedules aren't converted and
+        past days aren't moved into the history files (they're still left
+        out of the active calendar).
+        """
+        # convert schedules saved by older versions of the program
+        if not read_only and not self.store.exists() and os.path.exists('data.json'):
+            self.store.migrate('data.json')
+
+        # days before today can no longer be rescheduled, so they're moved
+        # into the history files and left out of the active calendar
+        start = day_offset(today or datetime.date.today())
+        if not read_only:
+            self.store.freeze(start)
+
+        # experiments are loaded in order of priority, highest first
+        experiments = self.store.load(mmap=True)
+        self.repeats = self.store.attribute('repeat')
+        self.calendar = PackedSchedule(start, window_days(start, experiments.values()))
+        for label, days in experiments.items():
+            self.calendar[label] = self.day_vector(days, label)
+
+    def day_vector(self, days, label):
+        """Converts absolute day offsets to a column of the active calendar"""
+        start, end = self.calendar.start, self.calendar.end
+        if label in self.repeats:
+            days = extend_repeat(np.asarray(days), self.repeats[label], end)
+        return day_vector(np.asarray(days)[np.asarray(days) >= start] - start, end - start)
+
+    def extend_window(self, last_day):
+        """Lengthens the active calendar so it reaches last_day"""
+        if last_day < self.calendar.end:
+            return
+        self.calendar.extend(last_day + 1)
+        # carry on indefinite experiments into the new days
+        for label in self.repeats:
+            if label in self.calendar:
+                self.calendar[label] = self.day_vector(self.calendar.offsets(label), label)
 
     def add(self, experiment):
         """Insert new dates into calendar attribute"""
-        self.new_experiment = experiment
+        self.add_many([experiment])
 
-        # Insert new experiment in the first column of dataframe to give it highest priority
-        try:
-            self.calendar.insert(loc=0, column=self.new_experiment.label,
-                                 value=self.new_experiment.measurement_days)
-        except ValueError as e:
-            # shouldn't need this exception as the name is already checked at an earlier stage..
-            print('\nAn experiment with that name already exists. Please try recreating an experiment with a different name.')
-            sys.exit()
+    @metrics.timer('add')
+    def add_many(self, experiments):
+        """
+        Inserts several experiments, listed from highest to lowest priority,
+        above all existing experiments. Collisions are only solved, and the
+        schedule only saved, once for the whole lot.
 
-        # reschedule older, lower priority experiments so there are not two tests on the same day
-        self.correct_collisions()
+        If someone else saves the schedule while this is going on, it's
+        reloaded and the experiments are added to it afresh, rather than
+        overwriting their changes.
+        """
+        for attempt in range(SAVE_ATTEMPTS):
+            self.insert_experiments(experiments)
+            try:
+                self.save_dataframe()
+            except StaleScheduleError:
+                if attempt == SAVE_ATTEMPTS - 1:
+                    raise
+                metrics.count('schedule conflicts')
+                self.reload()
+            else:
+                return
+
+    def insert_experiments(self, experiments):
+        """Adds experiments to the loaded schedule and solves the collisions, without saving"""
+        self.extend_window(max(max(experiment.measurement_days) for experiment in experiments))
+
+        # Insert new experiments at the top of the priority order to give them highest priority
+        for position, experiment in enumerate(experiments):
+            self.new_experiment = experiment
+            if self.new_experiment.label in self.calendar:
+                # shouldn't need this exception as the name is already checked at an earlier stage..
+                print('\nAn experiment with that name already exists. Please try recreating an experiment with a different name.')
+                sys.exit()
+            if self.new_experiment.repeat:
+                self.repeats[self.new_experiment.label] = self.new_experiment.repeat
+            tests = self.day_vector(self.new_experiment.measurement_days, self.new_experiment.label)
+            # higher priority experiments pick their instrument first
+            self.assignments[self.new_experiment.label] = self.assign_instrument(self.new_experiment, tests)
+            self.calendar.insert(position, self.new_experiment.label, tests)
 
-        self.save_dataframe()
+        # reschedule older, lower priority experiments so there are not two tests on the same day
+        self.correct_collisions(min(experiment.time_elapsed for experiment in experiments))
 
+    @metrics.timer('save')
     def save_dataframe(self):
         # write new schedule to file, which allows schedule to be amended in the future
-        with open('data.json', 'w') as file:
-            # converting json string to file type
-            json_file = json.loads(self.calendar.to_json(),
-                                   object_pairs_hook=OrderedDict)
-            json.dump(json_file, file, indent=2)
+        self.store.save(OrderedDict(self.calendar.items()),
+                        repeat=self.repeats, instrument=self.assignments)
 
-    def correct_collisions(self):
-        # convert dataframe to array
-        self.create_array()
+    def instrument_of(self, label):
+        """The instrument an experiment is booked on, by default the first one listed"""
+        instrument = self.assignments.get(label)
+        return self.instruments.get(instrument) or next(iter(self.instruments.values()))
 
+    def assign_instrument(self, experiment, tests):
+        """
+        Chooses which instrument a new experiment is booked on: the one asked
+        for, or of the instruments of the type asked for (or any instrument)
+        the one with the most room on the experiment's days.
+        """
+        candidates = candidate_instruments(self.instruments, experiment.instrument,
+                                           experiment.instrument_type)
+        if len(candidates) == 1:
+            return candidates[0]
+
+        # tests booked on each candidate per day
+        occupancy = np.stack([self.calendar.occupancy([label for label in self.calendar
+                                                       if self.instrument_of(label).name == name])
+                              for name in candidates])
+        capacity = np.stack([np.where(blocked, 0, room) for blocked, room in
+                             (self.daily_room(self.instruments[name]) for name in candidates)])
+
+        return least_loaded(candidates, occupancy, capacity, tests)
+
+    @metrics.timer('solve')
+    def correct_collisions(self, first_day=None):
         # truncate calendar to only include dates from the beginning
         # of the experiment being added
-        present_calendar = self.calendar_array[self.new_experiment.time_elapsed:, :]
-
-        # update calendar instance with updated test schedule
-        self.calendar_array[self.new_experiment.time_elapsed:, :] =\
-            self.update_test_dates(present_calendar)
-        self.calendar.iloc[:, :] = self.calendar_array[:, 1:]
-
-    def create_array(self):
-        # create weekends to prevent collision correction placing an "experiment"
-        # on sat/sundays
-        saturdays = np.arange(5, 365, 7)
-        sundays = saturdays + 1
-        # lists the day values which are weekends
-        weekends = np.concatenate((saturdays, sundays))
-
-        self.calendar_array = np.zeros((365, 1))
-        self.calendar_array[weekends, :] = 1
-
-        # concacentate weekend array and experiment array together, giving weekends
-        # highest priority so new experiments won't get placed on these days
-        self.calendar_array = np.concatenate(
-            (self.calendar_array, self.calendar.values), axis=1)
-
-    def update_test_dates(self, present_calendar):
-        test_count, collisions, free_days = self.analyse_calendar(present_calendar)
-        # remember to clear previous Google calendar events
-        self.collisions = True if len(collisions) > 0 else False
-        count = 0
-        # recalculate and move test schedules while there are days with collisions
-        # in the test calendar
-        while len(collisions) > 0:
-            # break out of program if caught in endless loop / taking too long
-            count += 1
-            if count > 1000000000:
-                print('Cannot find optimal solution to scheduling calendar. Too many experiments currently listed')
-                sys.exit()
-
-            # iterate through days collisions detected on
-            for day in collisions:
-                tests = present_calendar[day, :]
-
-                collision_tests = np.where(tests == tests.max())
-                oldest_test = np.max(collision_tests)  # get oldest test in collision
-
-                # determine nearest free day in schedule
-                try:
-                    day_differences = free_days - day
-                    min_date = np.argmin(np.abs(day_differences))  # index of closest day
-
-                except ValueError:
-                    print('There are no free days left in the existing timeframe :(\nPlease delete or downsample the frequency of lower priority experiments.')
-                    sys.exit()
-
-                day_delta = day_differences[min_date]  # number of days from collision date
-                # determine which direction the nearest free day is (past or future)
-                direction = np.sign(day_delta)
-
-                new_date = day + direction
-
-                present_calendar[new_date, oldest_test] += 1
-                present_calendar[day, oldest_test] -= 1
-
-                test_count, collisions, free_days = self.analyse_calendar(present_calendar)
-
+        if first_day is None:
+            first_day = self.new_experiment.time_elapsed
+        first_row = max(first_day - self.calendar.start, 0)
+
+        # each instrument's experiments are rescheduled separately, against
+        # the number of tests it can run each day
+        self.collisions = False
+        for instrument in self.instruments.values():
+            labels = [label for label in self.calendar
+                      if self.instrument_of(label) is instrument]
+            if not labels:
+                continue
+
+            # check for days over capacity on the packed schedule, and only
+            # unpack it for the solver if there are any
+            blocked, room = self.daily_room(instrument)
+            room = np.where(blocked, 0, room)
+            room[:first_row] = len(labels)
+            collision_days = self.calendar.collision_days(labels, room)
+            metrics.count('collision days', collision_days)
+            if not collision_days:
+                continue
+
+            # convert schedule to array
+            self.create_array(instrument, labels)
+            present_calendar = self.calendar_array[first_row:, :]
+            before = present_calendar.copy()
+
+            # update calendar instance with updated test schedule
+            try:
+                self.calendar_array[first_row:, :] = self.update_test_dates(
+                    present_calendar, self.daily_capacity[first_row:])
+            except InfeasibleScheduleError as e:
+                affected = sorted({labels[column - 1] for day, column in e.units if column > 0})
+                if affected:
+                    raise InfeasibleScheduleError(
+                        f"{e}\nExperiments affected on the {instrument.name}: {', '.join(affected)}", e.units) from e
+                raise
+            # only the experiments which moved are packed again
+            for column in np.flatnonzero(np.any(self.calendar_array[first_row:, 1:] != before[:, 1:], axis=0)):
+                self.calendar[labels[column]] = self.calendar_array[:, column + 1]
+
+    def daily_room(self, instrument):
+        """
+        The days in the window nothing can be booked on the instrument -
+        weekends, holidays and days it can't be used - and the number of tests
+        it can take each day. Days booked directly in the Google calendar
+        leave less room.
+        """
+        start, end = self.calendar.start, self.calendar.end
+        capacity = instrument.capacity_vector(np.arange(start, end)) -\
+            self.events.bookings(instrument.calendar_id, start, end)
+        return blackout_mask(start, end) | (capacity < 1), capacity
+
+    def create_array(self, instrument, labels):
+        # create weekends, holidays and days the instrument can't be used, to
+        # prevent collision correction placing an "experiment" on them
+        blocked, capacity = self.daily_room(instrument)
+
+        # blocked days come first, with highest priority, so new experiments
+        # won't get placed on these days
+        self.calendar_array = np.zeros((len(self.calendar), len(labels) + 1))
+        self.calendar_array[blocked, 0] = 1
+        # blocked days are full as soon as they're marked
+        self.daily_capacity = np.where(blocked, 1, capacity)
+
+        for column, label in enumerate(labels, 1):
+            self.calendar_array[:, column] = self.calendar[label]
+
+    def update_test_dates(self, present_calendar, capacity=None):
+        if capacity is None:
+            capacity = np.ones(len(present_calendar))
+        # note whether older experiments had to be moved to fit the new one in
+        if not np.any(np.sum(present_calendar, axis=1) > capacity):
+            return present_calendar
+        self.collisions = True
+
+        before = present_calendar[:, 1:].copy()
+        present_calendar = self.solver.solve(present_calendar, capacity)
+        metrics.count('tests moved', int(np.clip(before - present_calendar[:, 1:], 0, None).sum()))
+        if getattr(self.solver, 'timed_out', False):
+            print('\nThe solver ran out of time, so tests may have been moved further than needed.')
         return present_calendar
 
-    def analyse_calendar(self, schedule):
-        daily_test_count = np.sum(schedule, axis=1)
-        collisions = np.where(daily_test_count > 1)[0]
-        free_days = np.where(daily_test_count == 0)[0]
-
-        return daily_test_count, collisions, free_days
-
-    def Google_update(self):
+    @metrics.timer('sync')
+    def Google_update(self, full=False):
         '''
-        Function updates the saved experiment dates. It first creates text
-        files which lists all the dates which have been designated for the
-        experiments, which is then used to update the google calendar.
-        Text files are created to serve as an offline reference, and in case
-        of any errors which occur after this.
+        Function updates the google calendar with the saved experiment dates.
+        The dates designated for each experiment are compared with the events
+        recorded in the ledger, and only events for measurements which were
+        added, removed or moved are sent to the calendar. Regular measurements
+        are sent as recurring events, so most experiments only need a few.
+        Setting full clears every event and uploads the whole schedule again.
+        Every write is recorded in the ledger before it's sent and confirmed
+        once it's done, so if an update is interrupted the next one carries
+        on from where it stopped. Afterwards the events now in the calendar
+        are saved as a new version of the history of each experiment whose
+        events changed.
         '''
 
-        # clear all previously set calendar events if there are event collisions
-        if self.collisions:
-            self.clear_calendar(cli=False)
-
-        # create new dataframe to save data to a txt file from
-        txt_calendar = self.calendar.copy()
-        date_index = pd.DatetimeIndex(start=datetime.date(2018, 1, 1),
-                                      periods=365, freq='D')
-        txt_calendar.set_index(date_index, inplace=True)  # convert integers in index to dates
+        import progressbar
 
-        print('\nUploading updated test schedule to the Solartron Google calendar...')
+        if full:
+            self.clear_calendar(cli=False)
+        # a schedule saved by someone else since this one was loaded (e.g. an
+        # add which overtook this one) is newer, so it's the one uploaded
+        if self._calendar is not None and self.store.changed():
+            self.reload()
+
+        start = self.calendar.start
+        inserts, deletes = [], []
+        insert_count = 0
+        sent = OrderedDict()  # label -> (calendarId, event IDs written)
+        # deletes which failed before for experiments no longer in the
+        # schedule, e.g. ones deleted from the command line, are sent again
+        deletes.extend(('delete', {'calendarId': calendar_id, 'eventId': eventID})
+                       for label, eventID, calendar_id in self.ledger.deleting() if label not in self.calendar)
+        for column, days in self.calendar.items():
+            calendar_id = self.instrument_of(column).calendar_id
+
+            # events before the active window are history and stay as they are
+            recorded = self.ledger.events(column)
+            recurrences = self.ledger.recurrences(column)
+            new_events, changed, old_events, unchanged = plan_sync(
+                column, [(day, eventID, recurrences.get(eventID)) for eventID, _, day, _ in recorded],
+                days.tolist(), start)
+
+            # events not confirmed to be in the calendar, because an earlier
+            # update was interrupted or they've since been deleted or moved
+            # by hand, are sent again
+            confirmed = {eventID for eventID, event_calendar, day, state in recorded
+                         if state == LIVE and event_calendar == calendar_id and
+                         (not self.events.synced(calendar_id) or self.events.has_event(calendar_id, eventID, day))}
+            new_events += [(day, eventID, recurrences.get(eventID)) for day, eventID in unchanged
+                           if eventID not in confirmed]
+            # and changes to them are sent as inserts, which become updates if they are there after all
+            new_events += [event for event in changed if event[1] not in confirmed]
+            changed = [event for event in changed if event[1] in confirmed]
+            # as are writes still waiting from an earlier update to events the
+            # plan leaves alone, e.g. a recurring event before the window
+            # which was cut short
+            planned = {eventID for _, eventID, _ in new_events + changed}
+            planned.update(eventID for _, eventID in old_events + unchanged)
+            waiting = [(day, eventID, state) for eventID, _, day, state in recorded
+                       if state != LIVE and eventID not in planned]
+            new_events += [(day, eventID, recurrences.get(eventID)) for day, eventID, state in waiting
+                           if state == INSERTING]
+            old_events += [(day, eventID) for day, eventID, state in waiting if state == DELETING]
+            calendars = {eventID: event_calendar for eventID, event_calendar, _, _ in recorded}
+
+            written = [(day, eventID) for day, eventID, _ in new_events + changed]
+            self.ledger.begin(column, calendar_id, written, [eventID for day, eventID in old_events],
+                              recurrences={eventID: recurrence for _, eventID, recurrence in new_events + changed})
+            sent[column] = calendar_id, {eventID for day, eventID in written + old_events}
+            # the event bodies are only made as the uploader gets to them
+            inserts.append(self.create_events(column, new_events))
+            inserts.append(self.create_events(column, changed, method='update'))
+            insert_count += len(written)
+            deletes.extend(('delete', {'calendarId': calendars[eventID], 'eventId': eventID})
+                           for day, eventID in old_events)
+
+        print('\nUploading updated test schedule to the Google calendars...')
 
         # initialising progressbar to show progress of event creation
-        self.num_of_experiments = txt_calendar.sum(axis=0).sum(axis=0)
-        self.bar = progressbar.ProgressBar(maxval=self.num_of_experiments,
+        self.num_of_experiments = insert_count + len(deletes)
+        self.bar = progressbar.ProgressBar(maxval=max(self.num_of_experiments, 1),
+                                           # looked up now, in case output is redirected
+                                           fd=sys.stderr,
                                            widgets=[
                                                progressbar.Bar('◼', '', '', '◻'),
                                                progressbar.Percentage()])
         self.upload_count = 0
         self.bar.start()
-        for column in txt_calendar.columns:
-            # get array of dates from indices where experiments are
-            # listed (i.e. 1 instead of 0 in calendar array)
-            experiment_dates = txt_calendar[txt_calendar[column] == 1].\
-                loc[:, column].index.date
-            # convert array of datetime objects to a list of strings
-            experiment_dates = [datetime.datetime.strftime(date, '%d/%m/%y')
-                                for date in experiment_dates]
-            # create random unique identifiers for the calendar eventIDs
-            experiment_IDs = [''.join(choice('abcdefghijklmnopqrstuv0123456789')
-                                      for i in range(10)) for j in experiment_dates]
-            event_information = list(zip(experiment_dates, experiment_IDs))
-
-            # save previous version of experiment schedule
-            if os.path.exists(f'experiment_dates/{column}'):
-                copyfile(f'experiment_dates/{column}', f'experiment_dates/archive/{column}')
-
-            # write new experiment file with list of dates generated for the experiment
-            with open(f'experiment_dates/{column}', 'w') as file:
-                file.write(f'{event_information}')
-
-            # create new google calendar events for this column and the experiment dates listed
-            self.upload_experiments(column, event_information)
-            # sys.stdout.flush()
-
+        # events are only deleted from dates which are no longer in the
+        # schedule, so deletes and inserts never touch the same event ID
+        try:
+            failed = self.upload_experiments(deletes) + self.upload_experiments(itertools.chain.from_iterable(inserts))
+        finally:
+            # whatever went through is saved, even if the upload was stopped
+            self.backend.flush()
         self.bar.finish()
-
-    def upload_experiments(self, experiment_name, event_information):
-
-        for date, eventID in event_information:
-            self.upload_count += 1
-            self.bar.update(self.upload_count)  # increment progress bar with upload
-            UTCdate = datetime.datetime.strptime(date, '%d/%m/%y').strftime('%Y-%m-%dT')
-            start_time = UTCdate + '09:00:00.00'
-            end_time = UTCdate + '17:00:00.00'
+        self.bar = None
+
+        for column, (calendar_id, event_ids) in sent.items():
+            if not event_ids:
+                continue
+            # the local copy of the calendar is told about the writes which
+            # went through, so it's current without refreshing it
+            recorded = {eventID: (day, state) for eventID, _, day, state in self.ledger.events(column)}
+            inserted = [(column, recorded[eventID][0], eventID) for eventID in event_ids
+                        if recorded.get(eventID, (None, None))[1] == LIVE]
+            deleted = [eventID for eventID in event_ids if eventID not in recorded]
+            self.events.record(calendar_id, inserted=inserted, deleted=deleted)
+            # only experiments whose events changed get a new version
+            if inserted or deleted:
+                self.ledger.save_version(column)
+        self.events.save()
+
+    @property
+    def ledger(self):
+        if self._ledger is None:
+            self._ledger = EventLedger()
+            # convert the event lists saved by older versions of the program
+            if os.path.isdir('experiment_dates'):
+                self._ledger.migrate('experiment_dates', lambda label: self.instrument_of(label).calendar_id)
+        return self._ledger
+
+    def create_events(self, experiment_name, event_information, method='insert'):
+        """
+        Yields the calendar insert (or update) requests for an experiment's
+        (day offset, eventID, recurrence) events
+        """
+        instrument = self.instrument_of(experiment_name)
+        dates = iso_dates([day for day, eventID, recurrence in event_information]).tolist()
+        for date, (day, eventID, recurrence) in zip(dates, event_information):
+            start_time = f'{date}T{START_TIME}'
+            end_time = f'{date}T{END_TIME}'
 
             test_event = {
                 'id': eventID,
@@ -250,41 +444,123 @@ class Calendar:
                 },
                 'summary': experiment_name,
                 'start': {
-                    'timeZone': 'Europe/London',
+                    'timeZone': TIME_ZONE,
                     'dateTime': start_time
                 },
-                'location': 'IDG Room 116A',
+                'location': instrument.location,
                 'end': {
-                    'timeZone': 'Europe/London',
+                    'timeZone': TIME_ZONE,
                     'dateTime': end_time
                 },
+                # marks the event, and each occurrence of a recurring one, as a measurement
+                'extendedProperties': {'private': {'experiment': experiment_name}},
             }
+            if recurrence:
+                test_event['recurrence'] = recurrence.split('\n')
+            if method == 'update':
+                yield 'update', {'calendarId': instrument.calendar_id, 'eventId': eventID, 'body': test_event}
+            else:
+                yield 'insert', {'calendarId': instrument.calendar_id, 'body': test_event}
+
+    @metrics.timer('upload')
+    def upload_experiments(self, events):
+        """
+        Sends calendar writes in batches, keeping hold of any that failed.
+        events can be a generator, which is only read as fast as the writes
+        are sent. Writes are confirmed in the ledger as they go through.
+        """
+        try:
+            failed = self.backend.write(events, on_success=self.update_progress)
+        finally:
+            # writes confirmed so far are kept even if the upload is stopped,
+            # and the ledger isn't left locked
+            self.ledger.commit()
+            self.unconfirmed = 0
+
+        # deleting an event which is already gone (or was never created, if
+        # an upload was interrupted) leaves the calendar as it should be
+        gone = [item for item, error in failed if item[0] == 'delete' and status_of(error) in (404, 410)]
+        failed = [(item, error) for item, error in failed
+                  if not (item[0] == 'delete' and status_of(error) in (404, 410))]
+
+        # event IDs are derived from the experiment and date, so an event
+        # deleted earlier keeps its ID and has to be restored rather than
+        # inserted again
+        conflicts = [('update', dict(kwargs, eventId=kwargs['body']['id']))
+                     for (method, kwargs), error in failed
+                     if method == 'insert' and status_of(error) == 409]
+        failed = [(item, error) for item, error in failed
+                  if not (item[0] == 'insert' and status_of(error) == 409)]
+        if conflicts:
+            failed += self.backend.write(conflicts, on_success=self.update_progress)
+
+        for item in gone:
+            self.confirm_event(item, commit=False)
+        self.ledger.commit()
+        self.unconfirmed = 0
+
+        if failed:
+            print(f'\n{len(failed)} calendar updates failed, and will be sent again by the next update:')
+            for (method, kwargs), error in failed:
+                print(f"• {method} {event_key((method, kwargs))}: {error}")
+
+        return failed
+
+    def update_progress(self, item):
+        # writes are confirmed in the ledger as they happen, in case the
+        # upload doesn't get to finish
+        self.confirm_event(item, commit=False)
+        self.unconfirmed += 1
+        if self.unconfirmed >= CONFIRM_EVERY:
+            self.ledger.commit()
+            self.unconfirmed = 0
+        if self.bar is not None:
+            self.upload_count += 1
+            self.bar.update(self.upload_count)  # increment progress bar with upload
 
-            self.service.events().insert(
-                calendarId='nllc88qbvtkks5a7jquivl9ibc@group.calendar.google.com',
-                body=test_event).execute()
+    def confirm_event(self, item, commit=True):
+        method, kwargs = item
+        self.ledger.confirm(method, event_key(item), commit)
 
+    @metrics.timer('clear')
     def clear_calendar(self, exp_name='all', cli=True):
-        print('\nClearing old schedule from the Solartron Google calendar...')
+        print('\nClearing old schedule from the Google calendars...')
         if exp_name == 'all':
             delete_labels = self.experiment_labels
         else:
             delete_labels = [exp_name]
 
+        # first - remove all events from Google calendar
+        events = []
+        for experiment in delete_labels:
+            recorded = self.ledger.events(experiment)
+            self.ledger.begin(experiment, self.instrument_of(experiment).calendar_id,
+                              deletes=[eventID for eventID, _, _, _ in recorded])
+            events.extend(('delete', {'calendarId': calendar_id, 'eventId': eventID})
+                          for eventID, calendar_id, day, state in recorded)
+        try:
+            self.upload_experiments(events)
+        finally:
+            self.backend.flush()
+
         for experiment in delete_labels:
-            # first - remove all events from Google calendar
-            with open(f'experiment_dates/{experiment}', 'r') as file:
-                event_info = ast.literal_eval(file.read())  # read in exp file as list
-                for date, eventID in event_info:
-                    self.service.events().delete(
-                        calendarId='nllc88qbvtkks5a7jquivl9ibc@group.calendar.google.com', eventId=eventID).execute()
             if cli:
                 # If requested from the command line interface delete ALL traces of the experiment
-                os.remove(f'experiment_dates/{experiment}')
-                if os.path.exists(f'experiment_dates/archive/{experiment}'):
-                    os.remove(f'experiment_dates/archive/{experiment}')
+                self.ledger.forget(experiment)
 
         # third - remove experiment column from DataFrame - Only perform if requested from the CLI
         if cli:
-            self.calendar.drop(delete_labels, axis=1, inplace=True)
-            self.save_dataframe()
+            # the schedule doesn't need to be loaded just to remove an experiment
+            if self._calendar is not None:
+                for experiment in delete_labels:
+                    if experiment in self.calendar:
+                        self.calendar.remove(experiment)
+            for experiment in delete_labels:
+                self.store.remove(experiment)
+
+
+def event_key(item):
+    """Event ID a (method, kwargs) calendar write is for"""
+    method, kwargs = item
+    return kwargs.get('eventId') or kwargs['body']['id']
+
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+
+FORMAT_VERSION = 2
+# how long to wait for another process to finish saving the schedule, and
+# how old a lock has to be before it's taken to be left by a crashed process
+LOCK_TIMEOUT = 30
+STALE_LOCK = 120
+
+
+class StaleScheduleError(Exception):
+    '''Raised when saving a schedule which someone else has saved since it was loaded'''
+
+
+class ScheduleStore:
+    '''
+    Compact on-disk schedule.
+
+    Each experiment is saved as a sorted array of the day offsets it has
+    measurements on, in its own .npy file. A small index.json lists the
+    experiments in order of priority (highest first) along with the file
+    holding their days, so adding, removing or rescheduling one experiment
+    only rewrites that experiment's file and the index.
+
+    Days which have passed are moved by freeze() into a separate history file
+    for each experiment, which is never rewritten or loaded by the scheduler,
+    so the active files only hold days that can still be rescheduled.
+
+    Several people can use the same schedule at once. The index is replaced
+    in one step, so it's never seen half written, and carries a version
+    number which goes up with every change. save() refuses to overwrite
+    changes saved since the schedule was loaded, raising StaleScheduleError
+    so the caller can reload and try again. Writes hold a lock file only
+    while the new index is being written. Reading takes no lock: if a save
+    removes the files a reader's index lists, the reader reads the new index.
+    '''
+
+    def __init__(self, path='schedule'):
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.lock_path = os.path.join(path, 'index.lock')
+        # version of the index the last load() read, or this store last wrote
+        self.version = None
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def read_index(self):
+        if not self.exists():
+            return {'format': FORMAT_VERSION, 'experiments': []}
+
+        with open(self.index_path, 'r') as file:
+            index = json.load(file, object_pairs_hook=OrderedDict)
+        if index['format'] > FORMAT_VERSION:
+            raise ValueError(f'\nERROR: {self.index_path} was written by a newer version of this program.')
+        return index
+
+    def changed(self):
+        '''Whether the schedule has been saved by someone else since it was loaded'''
+        return self.version is not None and self.read_index().get('version', 0) != self.version
+
+    def labels(self):
+        '''Experiment labels in order of priority, without loading any schedules'''
+        return [entry['label'] for entry in self.read_index()['experiments']]
+
+    def read_files(self, read):
+        '''
+        Returns the index and read(index), reading the index again if the
+        files it lists are removed by a save() before read() gets to them
+        '''
+        while True:
+            index = self.read_index()
+            try:
+                return index, read(index)
+            except FileNotFoundError:
+                if self.read_index().get('version', 0) == index.get('version', 0):
+                    raise
+                metrics.count('schedule reads retried')
+
+    def load(self, mmap=False):
+        '''Returns an OrderedDict of experiment label -> array of active day offsets'''
+        def read(index):
+            return OrderedDict((entry['label'], np.load(os.path.join(self.path, entry['file']),
+                                                        mmap_mode='r' if mmap else None))
+                               for entry in index['experiments'])
+
+        index, experiments = self.read_files(read)
+        self.version = index.get('version', 0)
+        return experiments
+
+    def load_history(self, label):
+        '''Frozen day offsets of an experiment, from before the active window'''
+        def read(index):
+            for entry in index['experiments']:
+                if entry['label'] == label and entry.get('history'):
+                    return np.load(os.path.join(self.path, entry['history']))
+            return np.array([], dtype=np.int32)
+
+        return self.read_files(read)[1]
+
+    def attribute(self, key):
+        '''
+        Label -> value of an attribute saved alongside the experiments'
+        days, e.g. 'repeat' or 'instrument', for experiments which have one
+        '''
+        return {entry['label']: entry[key] for entry in self.read_index()['experiments']
+                if entry.get(key) is not None}
+
+    def save(self, experiments, **attributes):
+        '''
+        Saves an OrderedDict of experiment label -> active day offsets, in order
+        of priority. Only experiments whose days have changed are written.
+        Each keyword argument is a dict of label -> value for an attribute
+        saved with the experiments.
+
+        Raises StaleScheduleError if the schedule has been saved by someone
+        else since it was loaded.
+        '''
+        with self.commit_lock():
+            index = self.read_index()
+            if self.version is not None and index.get('version', 0) != self.version:
+                raise StaleScheduleError('The schedule has been changed by someone else since it was loaded.')
+            previous = {entry['label']: entry for entry in index['experiments']}
+
+            entries = []
+            for label, days in experiments.items():
+                days = np.sort(np.asarray(days, dtype=np.int32))
+                entry = previous.get(label)
+                if entry is None or not np.array_equal(self.load_days(entry), days):
+                    entry = self.write_days(label, days, entry)
+                for key, values in attributes.items():
+                    entry[key] = values.get(label)
+                entries.append(entry)
+
+            self.version = None
+            self.write_index(index, entries)
+            self.remove_unused(previous.values(), entries)
+
+    def remove(self, label):
+        '''Removes one experiment, leaving the others untouched'''
+        with self.commit_lock():
+            index = self.read_index()
+            previous = index['experiments']
+            entries = [entry for entry in previous if entry['label'] != label]
+            self.write_index(index, entries)
+            self.remove_unused(previous, entries)
+
+    def freeze(self, before):
+        '''Moves every day offset earlier than `before` into the history files'''
+        # most of the time there's nothing to freeze, and no need to lock
+        if not any(has_days_before(entry, before) for entry in self.read_index()['experiments']):
+            return
+
+        with self.commit_lock():
+            index = self.read_index()
+            previous = index['experiments']
+
+            entries = []
+            for entry in previous:
+                if not has_days_before(entry, before):
+                    entries.append(entry)
+                    continue
+
+                days = self.load_days(entry)
+                split = np.searchsorted(days, before)
+                history = np.concatenate((self.load_history(entry['label']), days[:split]))
+                entry = self.write_days(entry['label'], days[split:], entry)
+                entry['history'] = self.write_array(history.astype(np.int32))
+                entries.append(entry)
+
+            if entries != previous:
+                self.write_index(index, entries)
+                self.remove_unused(previous, entries)
+
+    def load_days(self, entry):
+        return np.load(os.path.join(self.path, entry['file']))
+
+    def write_days(self, label, days, entry=None):
+        entry = OrderedDict(entry or [('label', label)])
+        entry['file'] = self.write_array(days)
+        entry['count'] = int(len(days))
+        entry['first'] = int(days[0]) if len(days) else None
+        return entry
+
+    def write_array(self, days):
+        os.makedirs(self.path, exist_ok=True)
+        # file names are unique rather than based on the label, so labels
+        # don't need to be valid file names and old files are never overwritten
+        file_name = f'{uuid.uuid4().hex}.npy'
+        np.save(os.path.join(self.path, file_name), days)
+        metrics.count('bytes written to schedule/', os.path.getsize(os.path.join(self.path, file_name)))
+        return file_name
+
+    def write_index(self, index, entries):
+        '''
+        Replaces the index read as `index` with one listing entries, under
+        the next version number. Callers hold the commit lock.
+        '''
+        version = index.get('version', 0)
+        with atomic_write(self.index_path) as file:
+            json.dump({'format': FORMAT_VERSION, 'version': version + 1, 'experiments': entries},
+                      file, indent=2)
+        metrics.count('bytes written to schedule/', os.path.getsize(self.index_path))
+        # a change on top of the loaded schedule leaves it up to date
+        if self.version in (None, version):
+            self.version = version + 1
+
+    @contextmanager
+    def commit_lock(self):
+        '''
+        Holds the lock on writing the index, so each change is made on top
+        of the one before rather than at the same time
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) > STALE_LOCK:
+                        os.remove(self.lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'\nERROR: Timed out waiting for {self.lock_path}. If nobody else '
+                                       f'is changing the schedule it can be deleted.')
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.remove(self.lock_path)
+
+    def remove_unused(self, previous, entries):
+        in_use = {entry[key] for entry in entries for key in ('file', 'history') if entry.get(key)}
+        for entry in previous:
+            for key in ('file', 'history'):
+                if entry.get(key) and entry[key] not in in_use:
+                    os.remove(os.path.join(self.path, entry[key]))
+
+    def migrate(self, json_path='data.json'):
+        '''
+        One-shot conversion of a data.json schedule (a dense days x experiments
+        table) to this format. The old file is kept as data.json.bak.
+        '''
+        with open(json_path, 'r') as file:
+            # Use OrderedDict to keep the priority of the experiments added.
+            data = json.load(file, object_pairs_hook=OrderedDict)
+
+        experiments = OrderedDict()
+        for label, column in data.items():
+            # days are stored as string keys, which aren't in order
+            days = np.zeros(max([int(day) for day in column] + [-1]) + 1)
+            for day, value in column.items():
+                days[int(day)] = value or 0
+            experiments[label] = day_offsets(days)
+
+        self.save(experiments)
+        os.replace(json_path, json_path + '.bak')
+
+
+def has_days_before(entry, before):
+    # the first active day is kept in the index so experiments with nothing
+    # to freeze don't need to be loaded
+    return 'first' not in entry or (entry['first'] is not None and entry['first'] < before)
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Opens a file for writing in place of path, which replaces path in one
+    step once it has been written, so nobody reading path (or a program
+    stopping part way through writing it) ever leaves it half written
+    '''
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, f'.{os.path.basename(path)}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(temporary, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def day_offsets(day_vector):
+    '''Converts a vector of measurements per day to sorted day offsets'''
+    day_vector = np.clip(np.asarray(day_vector), 0, None).astype(np.int64)
+    return np.repeat(np.arange(len(day_vector), dtype=np.int32), day_vector)
+
+
+def day_vector(offsets, days):
+    '''Converts day offsets back to a vector of measurements per day'''
+    return np.bincount(np.asarray(offsets, dtype=np.int64), minlength=days)[:days].astype(float)
+
+
+if __name__ == '__main__':
+    ScheduleStore().migrate()
+    print('Converted data.json to the schedule/ directory')
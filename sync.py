@@ -0,0 +1,238 @@
+import base64
+import hashlib
+import datetime
+from collections import Counter, namedtuple
+
+from horizon import day_offset, iso_dates
+
+# measurements are booked from 9 till 5, London time
+START_TIME = '09:00:00'
+END_TIME = '17:00:00'
+TIME_ZONE = 'Europe/London'
+
+# the patterns regular measurements are looked for in, as the number of days
+# between them: every weekday (1), every week and every four weeks
+SERIES_STEPS = (1, 7, 28)
+# fewest measurements worth making into a recurring event
+MIN_SERIES = 3
+# most occurrences in a row a recurring event can skip
+MAX_SKIPPED = 1
+# the days a series of every weekday falls on
+WEEKDAYS = 'MO,TU,WE,TH,FR'
+
+Series = namedtuple('Series', 'first step count exdates')
+Series.__doc__ = '''
+A recurring event: count occurrences every step days from day offset
+first (every weekday if step is 1), without the occurrences on the day
+offsets in exdates.
+'''
+
+
+def event_id(label, date):
+    '''
+    Google calendar event ID for an experiment's measurement on a date.
+
+    IDs are derived from the experiment and date, so the same measurement
+    always has the same ID. They use the base32hex alphabet (a-v and 0-9)
+    that the Calendar API accepts for client provided IDs.
+    '''
+    digest = hashlib.sha1(f'{label}|{date}'.encode()).digest()
+    return base64.b32hexencode(digest).decode().lower().rstrip('=')
+
+
+def measurement_ids(label, days):
+    '''Event IDs for an experiment's measurements on several day offsets'''
+    return [event_id(label, f'{date[8:10]}/{date[5:7]}/{date[2:4]}') for date in iso_dates(days).tolist()]
+
+
+def plan_events(label, days):
+    '''
+    The events an experiment's measurements on the given day offsets are
+    uploaded as: a recurring event for each Series found in them, and a
+    single event for each of the other days. Returns (day offset, eventID,
+    recurrence) tuples by date, where day is the first day of a series and
+    recurrence its RRULE and EXDATE lines joined into one string, or None
+    for a single event.
+    '''
+    series, singles = find_series(days)
+    events = [(run.first, series_id(label, run), '\n'.join(series_rule(run))) for run in series]
+    events += [(day, eventID, None) for day, eventID in zip(singles, measurement_ids(label, singles))]
+    return sorted(events)
+
+
+def series_id(label, series):
+    '''Event ID for a recurring event, from the experiment, its first date and how often it repeats'''
+    date = iso_dates([series.first])[0]
+    return event_id(label, f'{date[8:10]}/{date[5:7]}/{date[2:4]}/{series.step}')
+
+
+def plan_sync(label, recorded, days, start):
+    '''
+    Works out the calendar writes which bring an experiment's events in line
+    with its newly solved measurement days.
+
+    recorded is the list of (day offset, eventID, recurrence) events in the
+    ledger for the experiment, and days the day offsets from start (the
+    beginning of the active window) it should now have measurements on.
+    Returns lists of the (day offset, eventID, recurrence) events to insert
+    and update, and the (day offset, eventID) events to delete and leave
+    untouched.
+
+    Events before start are history and are left as they are. A recurring
+    event which began before start and carries on into the active window is
+    kept if all of its later measurements are still wanted, and otherwise
+    cut short at start, with the days after planned afresh.
+    '''
+    remaining = Counter(days)
+    updates, unchanged = [], []
+    current = []
+    for day, eventID, recurrence in recorded:
+        if day >= start:
+            current.append((day, eventID, recurrence))
+            continue
+        if recurrence is None:
+            continue
+        series = parse_recurrence(day, recurrence)
+        later = [occurrence for occurrence in series_days(series) if occurrence >= start]
+        if not later:
+            continue
+        if not Counter(later) - remaining:
+            remaining -= Counter(later)
+            unchanged.append((day, eventID))
+        else:
+            past = Series(series.first, series.step, series_count(series, start),
+                          tuple(exdate for exdate in series.exdates if exdate < start))
+            updates.append((day, eventID, '\n'.join(series_rule(past))))
+
+    planned = plan_events(label, sorted(remaining.elements()))
+    previous = {eventID: recurrence for day, eventID, recurrence in current}
+    wanted = {eventID for day, eventID, recurrence in planned}
+
+    inserts = [event for event in planned if event[1] not in previous]
+    updates += [event for event in planned if event[1] in previous and previous[event[1]] != event[2]]
+    unchanged += [(day, eventID) for day, eventID, recurrence in planned
+                  if eventID in previous and previous[eventID] == recurrence]
+    deletes = [(day, eventID) for day, eventID, recurrence in current if eventID not in wanted]
+
+    return inserts, updates, deletes, unchanged
+
+
+def find_series(days, min_count=MIN_SERIES):
+    '''
+    Splits sorted day offsets into Series of regular measurements - every
+    weekday, every week or every four weeks - and the days which fit none.
+
+    A series can skip the odd day (e.g. a bank holiday, or a measurement
+    moved to make room for another experiment), which is listed as one of
+    its exdates. Series are found greedily from the earliest day, each
+    taking the pattern which covers the most measurements.
+    '''
+    remaining = Counter(days)
+    series, singles = [], []
+    for day in sorted(remaining):
+        while remaining[day]:
+            best = max((walk(day, step, remaining) for step in SERIES_STEPS), key=lambda run: len(run[1]))
+            step, hits, skipped = best
+            if len(hits) < min_count:
+                singles.extend([day] * remaining[day])
+                remaining[day] = 0
+                break
+            remaining -= Counter(hits)
+            series.append(Series(day, step, series_count(Series(day, step, None, ()), hits[-1] + 1),
+                                 tuple(skipped)))
+    return series, sorted(singles)
+
+
+def walk(day, step, remaining):
+    '''
+    Follows a pattern from day for as long as it keeps finding measurements,
+    returning the step, the days it found and the days it skipped
+    '''
+    hits, skipped, pending = [], [], []
+    occurrence = day
+    while True:
+        if remaining[occurrence]:
+            hits.append(occurrence)
+            skipped.extend(pending)
+            pending = []
+        elif len(pending) == MAX_SKIPPED:
+            return step, hits, skipped
+        else:
+            pending.append(occurrence)
+        occurrence = next_occurrence(occurrence, step)
+
+
+def next_occurrence(day, step):
+    if step == 1:
+        # daily measurements are only made on weekdays
+        return day + 1 if day % 7 < 4 else day + 7 - day % 7
+    return day + step
+
+
+def series_days(series):
+    '''The day offsets a Series has measurements on'''
+    days, occurrence = [], series.first
+    exdates = set(series.exdates)
+    for _ in range(series.count):
+        if occurrence not in exdates:
+            days.append(occurrence)
+        occurrence = next_occurrence(occurrence, series.step)
+    return days
+
+
+def series_count(series, end):
+    '''Number of occurrences of a series before day offset end'''
+    count, occurrence = 0, series.first
+    while occurrence < end:
+        count += 1
+        occurrence = next_occurrence(occurrence, series.step)
+    return count
+
+
+def series_rule(series):
+    '''The RRULE, and EXDATE if any days are skipped, for a Series of events at START_TIME'''
+    if series.step == 1:
+        rule = f'FREQ=DAILY;BYDAY={WEEKDAYS}'
+    elif series.step % 7 == 0:
+        rule = f'FREQ=WEEKLY;INTERVAL={series.step // 7}'
+    else:
+        rule = f'FREQ=DAILY;INTERVAL={series.step}'
+    lines = [f'RRULE:{rule};COUNT={series.count}']
+    if series.exdates:
+        time = START_TIME.replace(':', '')
+        lines.append(f'EXDATE;TZID={TIME_ZONE}:' +
+                     ','.join(date.replace('-', '') + 'T' + time for date in iso_dates(series.exdates).tolist()))
+    return lines
+
+
+def parse_recurrence(first, recurrence):
+    '''
+    The Series described by recurrence lines made by series_rule(), either
+    as a list or joined into one string, for an event on day offset first.
+    Raises ValueError for any other recurrence, e.g. one with no COUNT.
+    '''
+    if isinstance(recurrence, str):
+        recurrence = recurrence.split('\n')
+    step, count, exdates = None, None, ()
+    for line in recurrence:
+        name, _, value = line.partition(':')
+        if name == 'RRULE':
+            parts = dict(part.partition('=')[::2] for part in value.split(';'))
+            if ('COUNT' not in parts or parts.get('FREQ') not in ('DAILY', 'WEEKLY') or
+                    parts.get('BYDAY', WEEKDAYS) != WEEKDAYS or set(parts) - {'FREQ', 'INTERVAL', 'COUNT', 'BYDAY'}):
+                raise ValueError(f'Not a recurrence written by series_rule(): {line}')
+            count = int(parts['COUNT'])
+            if 'BYDAY' in parts:
+                step = 1
+            elif parts['FREQ'] == 'WEEKLY':
+                step = 7 * int(parts.get('INTERVAL', 1))
+            else:
+                step = int(parts.get('INTERVAL', 1))
+        elif name.startswith('EXDATE'):
+            exdates = tuple(day_offset(datetime.datetime.strptime(moment[:8], '%Y%m%d'))
+                            for moment in value.split(','))
+        else:
+            raise ValueError(f'Not a recurrence written by series_rule(): {line}')
+    if count is None:
+        raise ValueError('Recurrence has no RRULE')
+    return Series(first, step, count, exdates)
@@ -0,0 +1,147 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+from horizon import day_offset, offset_date, extend_repeat
+from recurrence import MONTH, blackout_mask, compile_schedules
+from resolver import InfeasibleScheduleError
+from storage import day_vector
+
+# a measurement pushed to another day costs as much as moving one a week
+DISPLACED_WEIGHT = 7
+
+Suggestion = namedtuple('Suggestion', 'date score displaced days_moved moved instrument')
+Suggestion.__doc__ = '''
+A start date scored by score_start_dates(). displaced is the number of
+other experiments' measurements which would move, days_moved the total
+number of days they'd move by, and moved the labels of the experiments
+affected. score is None if the experiment can't be fitted in.
+'''
+
+
+def score_start_dates(calendar, experiment, first, last, workers=None):
+    '''
+    Works out how disruptive it would be to start an experiment on each
+    possible day from first to last (dates, inclusive), without saving
+    anything or contacting Google. experiment needs its days, weeks and
+    months (and optionally instrument or instrument_type) set, but not a
+    start date.
+
+    Each start date is tried by adding the experiment to a copy of the
+    schedule and solving the collisions, as an add would. The score is the
+    sum, over the experiments which had to move, of
+
+        (DISPLACED_WEIGHT * measurements moved + days moved) * rank
+
+    where rank is 1 for the lowest priority experiment, 2 for the next and
+    so on, so disturbing high priority experiments costs more. Start dates
+    whose measurements all fit on free days score 0 without any solving,
+    and the rest are solved in parallel by `workers` processes.
+
+    Returns the Suggestions in order of score, best first, followed by any
+    start dates on which the experiment doesn't fit.
+    '''
+    with metrics.timer('what if'):
+        if calendar._calendar is None:
+            calendar.initialise_schedule(read_only=True)
+
+        closed_days = ()
+        if experiment.instrument:
+            closed_days = calendar.instruments[experiment.instrument].closed_days
+
+        # start dates can't be in the past or on blocked days
+        first, last = max(day_offset(first), calendar.calendar.start), day_offset(last)
+        starts = np.arange(first, last + 1)
+        starts = starts[~blackout_mask(first, last + 1, closed_days=closed_days)]
+        if not len(starts):
+            return []
+
+        # the measurement days for every start date at once
+        months = 0 if experiment.months == 'end' else int(experiment.months)
+        count = len(starts)
+        schedules = compile_schedules(starts, [experiment.days] * count, [experiment.weeks] * count,
+                                      [months] * count, closed_days=closed_days)
+        calendar.extend_window(max(int(days[-1]) for days in schedules))
+
+        start, end = calendar.calendar.start, calendar.calendar.end
+        labels_on, arrays = {}, {}
+        candidates, suggestions = [], []
+        for day, days in zip(starts, schedules):
+            if experiment.months == 'end':
+                days = extend_repeat(days, MONTH, end)
+            tests = day_vector(days - start, end - start)
+
+            instrument = calendar.assign_instrument(experiment, tests)
+            if instrument not in arrays:
+                labels_on[instrument] = [label for label in calendar.calendar
+                                         if calendar.instrument_of(label).name == instrument]
+                calendar.create_array(calendar.instruments[instrument], labels_on[instrument])
+                arrays[instrument] = calendar.calendar_array, calendar.daily_capacity
+
+            schedule, capacity = arrays[instrument]
+            # start dates which don't collide with anything need no solving
+            if not np.any((tests > 0) & (schedule.sum(axis=1) + tests > capacity)):
+                suggestions.append(Suggestion(offset_date(day), 0, 0, 0, [], instrument))
+            else:
+                candidates.append((day, instrument, tests))
+
+        jobs = [(instrument, tests, day - start) for day, instrument, tests in candidates]
+        if workers == 1 or len(jobs) < 2:
+            share(arrays, calendar.solver)
+            results = list(map(evaluate, jobs))
+        else:
+            # each process is sent the schedules once, rather than with every job
+            with ProcessPoolExecutor(max_workers=workers, initializer=share,
+                                     initargs=(arrays, calendar.solver)) as pool:
+                results = list(pool.map(evaluate, jobs, chunksize=max(len(jobs) // 16, 1)))
+            share({}, None)
+
+        for (day, instrument, tests), result in zip(candidates, results):
+            if result is None:
+                suggestions.append(Suggestion(offset_date(day), None, 0, 0, [], instrument))
+                continue
+            score, displaced, days_moved, moved = result
+            suggestions.append(Suggestion(offset_date(day), score, displaced, days_moved,
+                                          [labels_on[instrument][column] for column in moved], instrument))
+
+        metrics.count('start dates scored', len(suggestions))
+
+    return sorted(suggestions, key=lambda suggestion: (suggestion.score is None, suggestion.score or 0,
+                                                       suggestion.date))
+
+
+# instrument -> (schedule array, daily capacity) and the solver to use, for evaluate()
+_shared = {}
+
+
+def share(arrays, solver):
+    _shared.update(arrays=arrays, solver=solver)
+
+
+def evaluate(job):
+    '''
+    Solves an instrument's schedule with a new experiment's tests added at
+    the highest priority, returning (score, measurements displaced, days
+    moved, columns of the experiments moved), or None if it doesn't fit
+    '''
+    instrument, tests, first_row = job
+    schedule, capacity = _shared['arrays'][instrument]
+    solver = _shared['solver']
+    schedule = np.concatenate((schedule[:, :1], tests[:, None], schedule[:, 1:]), axis=1)
+    before = schedule[first_row:, 2:].copy()
+    try:
+        after = solver.solve(schedule[first_row:], capacity[first_row:])[:, 2:]
+    except InfeasibleScheduleError:
+        return None
+
+    difference = before - after
+    displaced = np.clip(difference, 0, None).sum(axis=0)
+    # the least total distance the measurements could have moved to get from
+    # before to after, i.e. the earth mover's distance along the days
+    days_moved = np.abs(np.cumsum(difference, axis=0)).sum(axis=0)
+    rank = np.arange(len(displaced), 0, -1)
+
+    score = int(np.sum((DISPLACED_WEIGHT * displaced + days_moved) * rank))
+    return score, int(displaced.sum()), int(days_moved.sum()), np.flatnonzero(displaced).tolist()